@@ -0,0 +1,332 @@
+'''
+Monkey ORM benchmarks
+
+run as: python bench_monkey.py [--db memory|file|both] [--sizes 1000,100000]
+                               [--json results.json] [--compare old.json]
+'''
+
+import os
+import sys
+import json
+import shutil
+import timeit
+import sqlite3
+import argparse
+import platform
+import tempfile
+import contextlib
+import collections
+import tracemalloc
+from monkey import *
+
+class BenchTab(Table):
+    id = Auto(primary_key=True)
+    title = Text()
+    counter = Integer()
+
+@contextlib.contextmanager
+def _store(db="memory"):
+    if db == "memory":
+        yield Store("sqlite://:memory:")
+        return
+    tmpdir = tempfile.mkdtemp()
+    try:
+        yield Store("sqlite://{}".format(os.path.join(tmpdir, "bench.db")))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _populate(store, rows):
+    store.create_table(BenchTab)
+    store.add_many(
+        BenchTab(title="title {}".format(i), counter=i) for i in range(rows))
+
+def _inline(val):
+    return "'{}'".format(val) if isinstance(val, str) else str(val)
+
+class _LiteralQueryset:
+    '''
+    Queryset.all as it was before parameterized compilation: values inlined
+    into a new SQL text per query, parsed and planned by sqlite each time,
+    and rows turned into records by the generic Table.fromtuple
+    '''
+    fromtuple = staticmethod(Table.fromtuple.__func__)
+
+    def __init__(self, tab_cls, cursor, where=None):
+        self._tab_cls = tab_cls
+        self._cursor = cursor
+        self._where = where
+        self._order_by = ""
+
+    def all(self):
+        if self._where is not None:
+            sql, params = self._where.compile()
+            where = "where {}".format(
+                sql.replace("?", "{}").format(*map(_inline, params)))
+        else:
+            where = ""
+        all_recs = self._cursor.execute(
+            "select * from {table} {where} {order_by}".format(
+                table=self._tab_cls.__table__,
+                where=where,
+                order_by=self._order_by
+                ).strip()).fetchall()
+        return [self.fromtuple(self._tab_cls, rec) for rec in all_recs]
+
+def bench_lookup(rows=1000, loops=10000, db="memory"):
+    '''
+    Hot primary key lookup loop: store(Tab, Tab.id == x).all()
+    '''
+    with _store(db) as store:
+        _populate(store, rows)
+        ids = [i % rows + 1 for i in range(loops)]
+
+        def literal():
+            for x in ids:
+                _LiteralQueryset(BenchTab, store._cursor, BenchTab.id == x).all()
+
+        def uncached():
+            for x in ids:
+                store._statements.clear()
+                store(BenchTab, BenchTab.id == x).all()
+
+        def cached():
+            for x in ids:
+                store(BenchTab, BenchTab.id == x).all()
+
+        results = {}
+        for name, fn in [("literal", literal), ("uncached", uncached), ("cached", cached)]:
+            best = min(timeit.repeat(fn, number=1, repeat=3))
+            results[name] = best / loops * 1e6
+    return results
+
+def bench_insert(rows=20000, db="memory"):
+    '''
+    Loading rows one by one with Store.add vs Store.add_many
+    '''
+    def one_by_one():
+        with _store(db) as store:
+            store.create_table(BenchTab)
+            for i in range(rows):
+                store.add(BenchTab(title="title", counter=i))
+
+    def one_tx():
+        with _store(db) as store:
+            store.create_table(BenchTab)
+            with store.transaction():
+                for i in range(rows):
+                    store.add(BenchTab(title="title", counter=i))
+
+    def bulk():
+        with _store(db) as store:
+            store.create_table(BenchTab)
+            store.add_many(BenchTab(title="title", counter=i) for i in range(rows))
+
+    # each add commits on its own, on disk that is a sync per row
+    if db != "memory":
+        rows = min(rows, 1000)
+    results = {}
+    for name, fn in [("add", one_by_one), ("add_tx", one_tx), ("add_many", bulk)]:
+        best = min(timeit.repeat(fn, number=1, repeat=3))
+        results[name] = rows / best
+    return results
+
+def bench_query(sizes=(1000, 100000, 1000000), db="memory"):
+    '''
+    Queryset.all() latency of a full table read, in msec
+    '''
+    results = {}
+    for rows in sizes:
+        with _store(db) as store:
+            _populate(store, rows)
+            repeat = 3 if rows <= 100000 else 1
+            best = min(timeit.repeat(
+                lambda: store(BenchTab).all(), number=1, repeat=repeat))
+            results[str(rows)] = best * 1e3
+    return results
+
+def bench_compile(loops=100000):
+    '''
+    Compiling expressions and queryset statements, usec per call
+    '''
+    store = Store("sqlite://:memory:")
+    expr = (BenchTab.counter > 10) & (BenchTab.title == "x") | BenchTab.id.is_in([1, 2, 3])
+
+    def expression():
+        for _ in range(loops):
+            expr.compile()
+
+    def statement():
+        for _ in range(loops):
+            store(BenchTab, expr).order_by(BenchTab.id)._select_sql()
+
+    def statement_uncached():
+        for _ in range(loops):
+            store._statements.clear()
+            store(BenchTab, expr).order_by(BenchTab.id)._select_sql()
+
+    results = {}
+    for name, fn in [
+            ("expression", expression),
+            ("statement", statement),
+            ("statement_uncached", statement_uncached)]:
+        best = min(timeit.repeat(fn, number=1, repeat=3))
+        results[name] = best / loops * 1e6
+    return results
+
+class _LegacyField:
+    # attribute access of records before MetaTable generated slots
+    def __init__(self, name):
+        self.self_name = name
+
+    def __get__(self, inst, owner):
+        if inst is None:
+            return self
+        if not hasattr(inst, "updated"):
+            inst.updated = False
+        return inst.columns[self.self_name]
+
+    def __set__(self, inst, val):
+        setattr(inst, "updated", True)
+        inst.columns[self.self_name] = val
+
+class _LegacyRecord:
+    # record layout before MetaTable generated slots: an OrderedDict
+    # of values plus a _<column> duplicate of each of them
+    id = _LegacyField("id")
+    title = _LegacyField("title")
+    counter = _LegacyField("counter")
+    defaults = collections.OrderedDict.fromkeys(["id", "title", "counter"])
+
+    def __init__(self, **kwargs):
+        self.columns = collections.OrderedDict.fromkeys(
+            self.__class__.defaults.keys())
+        self.columns.update(self.__class__.defaults)
+        self.columns.update(kwargs)
+        self.updated = False
+        for col_name, col_value in self.columns.items():
+            setattr(self, "_{}".format(col_name), col_value)
+
+def _bytes_per_record(cls, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    # values are shared between both layouts, only the records are counted
+    recs = [cls(id=i, title="title", counter=0) for i in range(rows)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del recs
+    return size / rows
+
+def bench_layout(rows=100000, loops=1000000):
+    '''
+    Memory per record and attribute read latency, old layout vs slots
+    '''
+    results = {}
+    for name, cls in [("legacy", _LegacyRecord), ("slots", BenchTab)]:
+        rec = cls(id=1, title="title", counter=0)
+        read = min(timeit.repeat(
+            "rec.title", globals={"rec": rec}, number=loops, repeat=3))
+        results[name] = {
+            "bytes_per_record": _bytes_per_record(cls, rows),
+            "read_nsec": read / loops * 1e9,
+            }
+    return results
+
+def bench_hydration(rows=100000):
+    '''
+    Turning row tuples into records: generic Table.fromtuple vs the
+    function MetaTable generates per table class
+    '''
+    data = [(i, "title", i) for i in range(rows)]
+    generic = Table.fromtuple.__func__
+
+    results = {}
+    for name, fn in [
+            ("generic", lambda: [generic(BenchTab, r) for r in data]),
+            ("generated", lambda: list(map(BenchTab.fromtuple, data)))]:
+        best = min(timeit.repeat(fn, number=1, repeat=3))
+        results[name] = best / rows * 1e9
+    return results
+
+# name, unit and whether a higher value is better, per benchmark
+UNITS = collections.OrderedDict([
+    ("lookup", ("usec per query", False)),
+    ("insert", ("rows per second", True)),
+    ("query", ("msec per all(), by table rows", False)),
+    ("compile", ("usec per call", False)),
+    ("hydration", ("nsec per row", False)),
+    ("layout", ("bytes per record / nsec per attribute read", False)),
+    ])
+
+def run(dbs=("memory",), sizes=(1000, 100000, 1000000)):
+    results = collections.OrderedDict()
+    for db in dbs:
+        results[db] = collections.OrderedDict([
+            ("lookup", bench_lookup(db=db)),
+            ("insert", bench_insert(db=db)),
+            ("query", bench_query(sizes, db=db)),
+            ])
+    results["compile"] = bench_compile()
+    results["hydration"] = bench_hydration()
+    results["layout"] = bench_layout()
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "results": results,
+        }
+
+# flattens results to {"memory.insert.add": value, ...}
+def _flatten(results, prefix=""):
+    flat = collections.OrderedDict()
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + "."))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+def _higher_is_better(name):
+    for part in name.split("."):
+        if part in UNITS:
+            return UNITS[part][1]
+    return False
+
+def print_results(results, baseline=None):
+    flat = _flatten(results["results"])
+    old = _flatten(baseline["results"]) if baseline else {}
+    for name, value in flat.items():
+        line = "  {:<40} {:14.2f}".format(name, value)
+        if name in old and old[name]:
+            # positive changes are improvements
+            if _higher_is_better(name):
+                change = (value - old[name]) / old[name] * 100
+            else:
+                change = (old[name] - value) / old[name] * 100
+            line += " {:+8.1f}%".format(change)
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Monkey ORM benchmarks")
+    parser.add_argument("--db", choices=["memory", "file", "both"], default="memory")
+    parser.add_argument("--sizes", default="1000,100000,1000000",
+        help="comma separated table sizes of the query benchmark")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of a previous run")
+    args = parser.parse_args(argv)
+
+    dbs = ("memory", "file") if args.db == "both" else (args.db,)
+    sizes = tuple(int(size) for size in args.sizes.split(","))
+    results = run(dbs, sizes)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    for name, (unit, _) in UNITS.items():
+        print("{}: {}".format(name, unit))
+    print_results(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
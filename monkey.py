@@ -6,131 +6,291 @@ License: GPLv2 or higher
 
 import re
 import copy
+import contextlib
+import itertools
 import sqlite3
 import collections
 import datetime
+import types
+import time
+import logging
+import traceback
+import warnings
+import operator
+import weakref
+import queue
+import threading
+import pathlib
+import asyncio
+import functools
+import atexit
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 
 class UnknownFieldProperty(Exception): pass
 class NoTableDefined(Exception): pass
 class NotUniquePrimaryKey(Exception): pass
+class RelationNotLoaded(Exception):
+    def __init__(self, fld_name):
+        msg = "Relation '{}' was not loaded, use select_related() or prefetch_related()".format(fld_name)
+        super(RelationNotLoaded, self).__init__(msg)
+class NotUniqueField(Exception):
+    def __init__(self, fld_name):
+        msg = "Field '{}' is neither unique nor a primary key".format(fld_name)
+        super(NotUniqueField, self).__init__(msg)
+class RepeatedQuery(Exception):
+    def __init__(self, sql, count, frame):
+        msg = "Query run {} times, last from {}:{}: {}".format(
+            count, frame.filename, frame.lineno, sql)
+        super(RepeatedQuery, self).__init__(msg)
+class RepeatedQueryWarning(UserWarning): pass
+class PoolTimeout(Exception): pass
+class ReadOnlyTransaction(Exception): pass
+class WriteBehindError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+        msg = "{} buffered records could not be written, first error: {}".format(
+            len(errors), errors[0][1])
+        super(WriteBehindError, self).__init__(msg)
 class UnknownTableColumn(Exception):
     def __init__(self, fld_name):
         msg = "Unknown column name '{}'".format(fld_name)
         super(UnknownTableColumn, self).__init__(msg)
 
+# default of arguments for which None is a valid value
+_missing = object()
+
+# Expression operands are either nested expressions, table fields
+# (rendered as column names qualified by the table name) or plain values, which are never inlined
+# into the SQL text but passed to sqlite as "?" parameters.
+def _shape(val, params):
+    if isinstance(val, (Expr, ExprResult)):
+        return val.shape(params)
+    if isinstance(val, Field):
+        return val.qual_name
+    params.append(val)
+    return None
+
+def _sql(val):
+    if isinstance(val, (Expr, ExprResult)):
+        return str(val)
+    if isinstance(val, Field):
+        return val.qual_name
+    return "?"
+
 class Expr:
+    template = ""
+    null_template = None
+
     def __init__(self, left, right):
-        right, _ = self._escape_str([right, None])
         self.left = left
         self.right = right
 
-    def _escape_str(self, params):
-        return map(
-            lambda x: "'{}'".format(x) if isinstance(x, str) else x,
-            params)
+    # comparing with None tests for NULL instead of binding it, returns
+    # the other operand or _missing when the expression binds both
+    def _null_operand(self):
+        if self.null_template is None:
+            return _missing
+        if self.right is None:
+            return self.left
+        if self.left is None:
+            return self.right
+        return _missing
+
+    # shape is a hashable key describing everything but the parameter
+    # values, two expressions of the same shape render the same SQL
+    def shape(self, params):
+        operand = self._null_operand()
+        if operand is not _missing:
+            return (self.__class__, _shape(operand, params), _missing)
+        return (
+            self.__class__,
+            _shape(self.left, params),
+            _shape(self.right, params))
+
+    def compile(self):
+        params = []
+        self.shape(params)
+        return str(self), tuple(params)
 
-class Eq(Expr):
     def __str__(self):
-        return "{left} = {right}".format(
-            left=self.left,
-            right=self.right
+        operand = self._null_operand()
+        if operand is not _missing:
+            return self.null_template.format(left=_sql(operand))
+        return self.template.format(
+            left=_sql(self.left),
+            right=_sql(self.right)
             )
 
+class Eq(Expr):
+    template = "{left} = {right}"
+    null_template = "{left} is null"
+
 class Neq(Expr):
-    def __str__(self):
-        return "{left} != {right}".format(
-            left=self.left,
-            right=self.right
-            )
+    template = "{left} != {right}"
+    null_template = "{left} is not null"
 
 class And(Expr):
-    def __str__(self):
-        return "({left}) and ({right})".format(
-            left=self.left,
-            right=self.right
-            )
+    template = "({left}) and ({right})"
 
 class Or(Expr):
-    def __str__(self):
-        return "({left}) or ({right})".format(
-            left=self.left,
-            right=self.right
-            )
+    template = "({left}) or ({right})"
 
 class Gt(Expr):
-    def __str__(self):
-        return "{left} > {right}".format(
-            left=self.left,
-            right=self.right
-            )
+    template = "{left} > {right}"
 
 class Lt(Expr):
-    def __str__(self):
-        return "{left} < {right}".format(
-            left=self.left,
-            right=self.right
-            )
+    template = "{left} < {right}"
 
 class Gte(Expr):
-    def __str__(self):
-        return "{left} >= {right}".format(
-            left=self.left,
-            right=self.right
-            )
+    template = "{left} >= {right}"
 
 class Lte(Expr):
-    def __str__(self):
-        return "{left} <= {right}".format(
-            left=self.left,
-            right=self.right
-            )
+    template = "{left} <= {right}"
+
+class Add(Expr):
+    template = "({left} + {right})"
+
+class Sub(Expr):
+    template = "({left} - {right})"
+
+class Mul(Expr):
+    template = "({left} * {right})"
+
+class Div(Expr):
+    template = "({left} / {right})"
 
 class In(Expr):
     def __init__(self, col, in_lst):
         self._col = col
-        in_lst = self._escape_str(in_lst)
-        self._in_lst = in_lst
+        self._in_lst = list(in_lst)
+
+    def shape(self, params):
+        params.extend(self._in_lst)
+        return (self.__class__, _shape(self._col, params), len(self._in_lst))
 
     def __str__(self):
         return "{col} in ({lst})".format(
-            col=self._col,
-            lst=", ".join(self._in_lst)
+            col=_sql(self._col),
+            lst=", ".join("?" for _ in self._in_lst)
             )
 
 class Like(Expr):
+    def shape(self, params):
+        params.append("%{}%".format(self.right))
+        return (self.__class__, _shape(self.left, params))
+
     def __str__(self):
-        return "{col} like {expr}".format(
-            col=self.left,
-            expr="%{}%".format(self.right)
-            )
+        return "{col} like ?".format(col=_sql(self.left))
 
 class Asc(Expr):
     def __init__(self, col):
         self._col = col
 
+    def shape(self, params):
+        return (self.__class__, _shape(self._col, params))
+
     def __str__(self):
-        return "{} asc".format(self._col.self_name)
+        return "{} asc".format(_sql(self._col))
 
 class Desc(Asc):
     def __str__(self):
-        return "{} desc".format(self._col.self_name)
+        return "{} desc".format(_sql(self._col))
+
+class Aggregate(Expr):
+    func = ""
+
+    def __init__(self, col):
+        self._col = col
+
+    def shape(self, params):
+        return (self.__class__, _shape(self._col, params))
+
+    def __str__(self):
+        return "{}({})".format(self.func, _sql(self._col))
+
+class Count(Aggregate):
+    func = "count"
+
+    # Count() counts rows
+    def __init__(self, col=None):
+        self._col = col
+
+    def shape(self, params):
+        if self._col is None:
+            return (self.__class__, None)
+        return super(Count, self).shape(params)
+
+    def __str__(self):
+        if self._col is None:
+            return "count(*)"
+        return super(Count, self).__str__()
+
+class Sum(Aggregate):
+    func = "sum"
+
+class Avg(Aggregate):
+    func = "avg"
+
+class Min(Aggregate):
+    func = "min"
+
+class Max(Aggregate):
+    func = "max"
 
 class ExprResult:
     def __init__(self, expr):
         self._expr = expr
 
+    def shape(self, params):
+        return self._expr.shape(params)
+
+    def compile(self):
+        return self._expr.compile()
+
     def __str__(self):
         return str(self._expr)
 
     def __and__(self, other):
-        return And(self, other)
-    __rand__ = __and__
+        return ExprResult(And(self, other))
+
+    def __rand__(self, other):
+        return ExprResult(And(other, self))
 
     def __or__(self, other):
-        return Or(self, other)
-    __ror__ = __or__
+        return ExprResult(Or(self, other))
+
+    def __ror__(self, other):
+        return ExprResult(Or(other, self))
+
+    def __add__(self, other):
+        return ExprResult(Add(self, other))
+
+    def __radd__(self, other):
+        return ExprResult(Add(other, self))
+
+    def __sub__(self, other):
+        return ExprResult(Sub(self, other))
+
+    def __rsub__(self, other):
+        return ExprResult(Sub(other, self))
 
-class Field:
+    def __mul__(self, other):
+        return ExprResult(Mul(self, other))
+
+    def __rmul__(self, other):
+        return ExprResult(Mul(other, self))
+
+    def __truediv__(self, other):
+        return ExprResult(Div(self, other))
+
+    def __rtruediv__(self, other):
+        return ExprResult(Div(other, self))
+
+# Fields are properties: once MetaTable binds a field to its table class,
+# reading the attribute of a record calls a C level getter of the slot
+# holding the value, writing it also marks the column as changed.
+class Field(property):
     affinity = ""
 
     def __init__(self, **kwargs):
@@ -144,7 +304,8 @@ class Field:
         "max_length": None,
         "date": None,
         "time": None,
-        "affinity": None}
+        "affinity": None,
+        "index": False}
         if not set(kwargs.keys()).issubset(set(self.allowed_props.keys())):
             # TODO: make it clear what field property is wrong
             raise UnknownFieldProperty
@@ -159,28 +320,52 @@ class Field:
             self.allowed_props["default"] = "'{}'".format(self.allowed_props["default"])
 
     def __eq__(self, other):
-        return ExprResult(Eq(self.self_name, other))
+        return ExprResult(Eq(self, other))
 
     def __ne__(self, other):
-        return ExprResult(Neq(self.self_name, other))
+        return ExprResult(Neq(self, other))
 
     def __gt__(self, other):
-        return ExprResult(Gt(self.self_name, other))
+        return ExprResult(Gt(self, other))
 
     def __lt__(self, other):
-        return ExprResult(Lt(self.self_name, other))
+        return ExprResult(Lt(self, other))
 
     def __ge__(self, other):
-        return ExprResult(Gte(self.self_name, other))
+        return ExprResult(Gte(self, other))
 
     def __le__(self, other):
-        return ExprResult(Lte(self.self_name, other))
+        return ExprResult(Lte(self, other))
 
     def is_in(self, lst):
-        return ExprResult(In(self.self_name, lst))
+        return ExprResult(In(self, lst))
 
     def like(self, other):
-        return ExprResult(Like(self.self_name, other))
+        return ExprResult(Like(self, other))
+
+    def __add__(self, other):
+        return ExprResult(Add(self, other))
+
+    def __radd__(self, other):
+        return ExprResult(Add(other, self))
+
+    def __sub__(self, other):
+        return ExprResult(Sub(self, other))
+
+    def __rsub__(self, other):
+        return ExprResult(Sub(other, self))
+
+    def __mul__(self, other):
+        return ExprResult(Mul(self, other))
+
+    def __rmul__(self, other):
+        return ExprResult(Mul(other, self))
+
+    def __truediv__(self, other):
+        return ExprResult(Div(self, other))
+
+    def __rtruediv__(self, other):
+        return ExprResult(Div(other, self))
 
     def __str__(self):
         def add_prop(s, prop):
@@ -199,16 +384,20 @@ class Field:
             res = add_prop(res, "default {}".format(allowed_props["default"]))
         return res.strip()
 
-    def __get__(self, inst, owner):
-        if inst is None:
-            return self
-        if not hasattr(inst, "updated"):
-            inst.updated = False
-        return inst.columns[self.self_name]
+    @property
+    def qual_name(self):
+        return "{}.{}".format(self.tab_name, self.self_name)
+
+    def _bind(self, table_cls, bit):
+        set_slot = table_cls.__dict__["_" + self.self_name].__set__
+        mask = 1 << bit
+
+        def fset(inst, val):
+            set_slot(inst, val)
+            inst._dirty |= mask
 
-    def __set__(self, inst, val):
-        setattr(inst, "updated", True)
-        inst.columns[self.self_name] = val
+        property.__init__(
+            self, operator.attrgetter("_" + self.self_name), fset)
 
 class Auto(Field):
     affinity = "integer"
@@ -261,8 +450,13 @@ class ForeignKey(Field):
 
     @type_err_to_no_table
     def __init__(self, table_cls, **kwargs):
+        self._dependent_tab = table_cls
         super(ForeignKey, self).__init__(**kwargs)
 
+    @property
+    def dependent_tab(self):
+        return self._dependent_tab
+
 class ManyToMany(Field):
     affinity = ""
 
@@ -279,6 +473,117 @@ class ManyToMany(Field):
     def dependent_tab(self):
         return self._dependent_tab
 
+    @property
+    def link_tab_name(self):
+        return "{}_{}".format(self.tab_name, self.dependent_tab_name)
+
+    # the related records loaded by Queryset.prefetch_related()
+    def __get__(self, inst, owner):
+        if inst is None:
+            return self
+        return inst.related(self)
+
+# sqlite doesn't accept parameters in index definitions,
+# so their values are written as literals
+def _literal(val):
+    if val is None:
+        return "null"
+    if isinstance(val, bool):
+        return str(int(val))
+    if isinstance(val, (int, float)):
+        return repr(val)
+    if isinstance(val, bytes):
+        return "X'{}'".format(val.hex())
+    return "'{}'".format(str(val).replace("'", "''"))
+
+class Index:
+    '''
+    Index on fields, expressions (Tab.a * Tab.b) or SQL strings
+    ("lower(name)"), partial when where is given. Tables declare them
+    in __indexes__, fields with index=True get one each.
+    '''
+    def __init__(self, *cols, unique=False, where=None, name=None):
+        self.cols = cols
+        self.unique = unique
+        self.where = where
+        self.name = name
+
+    # renders an expression with literal values and bare column
+    # names, as sqlite prohibits "table.column" in index expressions
+    def _render(self, expr, tab_name):
+        if isinstance(expr, str):
+            return expr
+        params = []
+        _shape(expr, params)
+        sql = re.sub(r"\b{}\.".format(re.escape(tab_name)), "", _sql(expr))
+        parts = sql.split("?")
+        return "".join(
+            part + (_literal(params[i]) if i < len(params) else "")
+            for i, part in enumerate(parts))
+
+    def sql(self, tab_name):
+        res = "create {unique}index if not exists {name} on {table} ({cols})".format(
+            unique="unique " if self.unique else "",
+            name=self.name,
+            table=tab_name,
+            cols=", ".join(self._render(col, tab_name) for col in self.cols))
+        if self.where is not None:
+            res = "{} where {}".format(res, self._render(self.where, tab_name))
+        return res
+
+# reads the given columns of a record as a tuple
+def _values_getter(cols):
+    slots = ["_{}".format(k) for k in cols]
+    if not slots:
+        return lambda inst: ()
+    if len(slots) == 1:
+        getter = operator.attrgetter(slots[0])
+        return lambda inst: (getter(inst),)
+    return operator.attrgetter(*slots)
+
+_HYDRATOR_TEMPLATE = """
+def fromtuple(row):
+    inst = new(cls)
+{body}
+    return inst
+
+def row_factory(cursor, row):
+    inst = new(cls)
+{body}
+    return inst
+"""
+
+# generates functions turning a row with the given columns, in that
+# order, into a record of table_cls without validation or temporary
+# dicts, columns missing from the row are set to None
+def _hydrators(table_cls, cols):
+    lines = []
+    if cols:
+        lines.append("{}, = row".format(
+            ", ".join("inst._{}".format(k) for k in cols)))
+    lines.extend("inst._{} = None".format(k)
+        for k in table_cls.columns if k not in cols)
+    lines.append("inst._dirty = 0")
+    lines.append("inst._persisted = True")
+    lines.append("inst._related = None")
+    namespace = {"new": object.__new__, "cls": table_cls}
+    exec(_HYDRATOR_TEMPLATE.format(
+        body="\n".join("    " + line for line in lines)), namespace)
+    return namespace["fromtuple"], namespace["row_factory"]
+
+class _Columns:
+    # Table.columns are the column definitions,
+    # record.columns is a read-only snapshot of the record values,
+    # which are changed through the attributes
+    def __init__(self, defs):
+        self.defs = defs
+
+    def __get__(self, inst, owner):
+        if inst is None:
+            return self.defs
+        return types.MappingProxyType(collections.OrderedDict(
+            (k, getattr(inst, "_{}".format(k))) for k in self.defs))
+
 class MetaTable(type):
     @classmethod
     def __prepare__(meta, name, bases):
@@ -300,105 +605,1332 @@ class MetaTable(type):
         for fld_name, fld_instance in clsdict.items():
             if isinstance(fld_instance, Field):
                 fld_instance.self_name = fld_name
+                fld_instance.tab_name = clsdict["__table__"]
                 if not isinstance(fld_instance, ManyToMany):
                     columns[fld_name] = str(fld_instance)
                     defaults[fld_name] = fld_instance.allowed_props["default"]
                 else:
                     pass
                     #columns[fld_name] = Queryset(fld_instance.dependent_tab)
-        clsdict["columns"] = columns
+        # every column value is stored once, in a slot named _<column>
+        if not "__slots__" in clsdict:
+            clsdict["__slots__"] = tuple(
+                "_{}".format(fld_name) for fld_name in columns)
+        clsdict["columns"] = _Columns(columns)
         clsdict["defaults"] = defaults
+        indexes = [Index(fld_instance) for fld_instance in clsdict.values()
+            if isinstance(fld_instance, Field) and fld_instance.allowed_props["index"]]
+        indexes.extend(clsdict.get("__indexes__", ()))
+        for n, index in enumerate(indexes):
+            if index.name is None:
+                names = [col.self_name for col in index.cols if isinstance(col, Field)]
+                if len(names) == len(index.cols):
+                    index.name = "{}_{}_idx".format(clsdict["__table__"], "_".join(names))
+                else:
+                    index.name = "{}_idx{}".format(clsdict["__table__"], n)
+        clsdict["indexes"] = indexes
         clsdict["field_defs"] = ", ".join(["{} {}".format(fld_name, fld_def)
             for fld_name, fld_def in columns.items()
             if not isinstance(fld_def, Queryset)])
 
-        return type.__new__(meta, newcls, bases, clsdict)
+        cls = type.__new__(meta, newcls, bases, clsdict)
+        for bit, fld_name in enumerate(columns):
+            clsdict[fld_name]._bind(cls, bit)
+        if columns:
+            fromtuple, row_factory = _hydrators(cls, tuple(columns))
+            cls.fromtuple = staticmethod(fromtuple)
+            cls.row_factory = staticmethod(row_factory)
+        return cls
 
 class Table(metaclass=MetaTable):
+    # _dirty is a bit mask of the columns changed since the record
+    # was loaded or saved, bits follow the order of columns
+    # _related holds records loaded by select_related() and
+    # prefetch_related(), keyed by field name
+    __slots__ = ("_dirty", "_persisted", "_related", "__weakref__")
+
+    # table classes get generated fromtuple() and row_factory()
+    # functions, these are the generic versions
     @classmethod
     def fromtuple(cls, t):
         kwargs = dict(zip(cls.columns.keys(), t))
-        return cls(**kwargs)
+        inst = cls(**kwargs)
+        inst._persisted = True
+        return inst
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        return cls.fromtuple(row)
 
     def __init__(self, **kwargs):
-        self.columns = collections.OrderedDict.fromkeys(
-            self.__class__.columns.keys())
+        columns = self.__class__.columns
         # check if nonexistent col names provided
         for k in kwargs.keys():
-            if not k in self.columns.keys():
+            if not k in columns:
                 raise UnknownTableColumn(k)
         # TODO: deny to update any m2m column
-        self.columns.update(self.__class__.defaults)
-        self.columns.update(kwargs)
-        self.updated = False
+        for k, default in self.__class__.defaults.items():
+            setattr(self, "_{}".format(k), kwargs.get(k, default))
+        self._dirty = 0
+        self._persisted = False
+        self._related = None
+
+    def related(self, field):
+        if self._related is None or not field.self_name in self._related:
+            raise RelationNotLoaded(field.self_name)
+        return self._related[field.self_name]
 
-        for col_name, col_value in self.columns.items():
-            setattr(self, "_{}".format(col_name), col_value)
+    @property
+    def updated(self):
+        return self._dirty != 0
+
+    def _changed(self):
+        dirty = self._dirty
+        if not dirty:
+            return ()
+        return tuple(k for bit, k in enumerate(self.__class__.columns)
+            if dirty >> bit & 1)
 
     def values(self, with_id=False):
-        # TODO: get rid of this monkey code :)
-        if with_id:
-            keys = self.columns.keys()
-        else:
-            keys =  filter(lambda x: x != "id", self.columns.keys())
-        return [self.columns[k] for k in keys]
+        return [getattr(self, "_{}".format(k)) for k in self.keys(with_id)]
 
     def keys(self, with_id=False):
-        if with_id:
-            keys = self.columns.keys()
-        else:
-            keys = filter(lambda x: x != "id", self.columns.keys())
-        return [k for k in keys]
+        return [k for k in self.__class__.columns.keys()
+            if with_id or k != "id"]
+
+CacheInfo = collections.namedtuple(
+    "CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+class ResultCache:
+    '''
+    LRU cache of fetched rows keyed by SQL text and parameters, entries
+    expire after ttl seconds and are dropped when one of the tables they
+    were read from is written to
+    '''
+    def __init__(self, maxsize=128, ttl=None, max_rows=10000):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # bigger results aren't worth keeping in memory
+        self.max_rows = max_rows
+        self.hits = self.misses = self.evictions = 0
+        # bumped by invalidate(), rows read across it may be outdated
+        self.version = 0
+        self._entries = collections.OrderedDict()
+        self._by_table = collections.defaultdict(set)
+        # pooled stores share the cache between threads
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, tables, rows = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return rows
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    # version is the one read before fetching the rows
+    def put(self, key, tables, rows, version=None):
+        if len(rows) > self.max_rows:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        tables = tuple(table.lower() for table in tables)
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, tables, rows)
+            for table in tables:
+                self._by_table[table].add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, tables, _ = self._entries.pop(key)
+        for table in tables:
+            self._by_table[table].discard(key)
+
+    # drops the results read from the given tables, or all of them
+    def invalidate(self, *tables):
+        with self._lock:
+            self.version += 1
+            if not tables:
+                self._entries.clear()
+                self._by_table.clear()
+                return
+            for table in tables:
+                for key in list(self._by_table.pop(table.lower(), ())):
+                    if key in self._entries:
+                        self._remove(key)
+
+    def info(self):
+        return CacheInfo(
+            self.hits, self.misses, self.evictions,
+            self.maxsize, len(self._entries))
+
+# one row of sqlite's query plan
+PlanStep = collections.namedtuple("PlanStep", ["id", "parent", "detail"])
+
+# a statement whose plan scans a large table, and the index that would
+# let sqlite search it instead
+Advice = collections.namedtuple(
+    "Advice", ["sql", "count", "table", "rows", "detail", "index"])
+
+def _has_field(fields, fld):
+    # Field overloads ==, so "in" can't be used on lists of fields
+    return any(f is fld for f in fields)
+
+# fields of tab_name compared for equality and by range in an expression
+def _compared_fields(expr, tab_name, eq, ranged):
+    if isinstance(expr, ExprResult):
+        _compared_fields(expr._expr, tab_name, eq, ranged)
+    elif isinstance(expr, (And, Or)):
+        _compared_fields(expr.left, tab_name, eq, ranged)
+        _compared_fields(expr.right, tab_name, eq, ranged)
+    elif isinstance(expr, (Eq, In, Gt, Lt, Gte, Lte)):
+        dest = eq if isinstance(expr, (Eq, In)) else ranged
+        operands = (expr._col,) if isinstance(expr, In) else (expr.left, expr.right)
+        for fld in operands:
+            if isinstance(fld, Field) and fld.tab_name == tab_name and not _has_field(dest, fld):
+                dest.append(fld)
+
+class IndexAdvisor:
+    '''
+    Records the querysets run by a store and looks for full scans of
+    tables having at least min_rows rows in their query plans
+    '''
+    _scan_re = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+    def __init__(self, store, min_rows=1000):
+        self._store = store
+        self.min_rows = min_rows
+        # SQL text -> [count, params, table name, index columns]
+        self._queries = collections.OrderedDict()
+
+    def record(self, qs, sql, params):
+        entry = self._queries.get(sql)
+        if entry is not None:
+            entry[0] += 1
+            return
+        tab_name = qs._tab_cls.__table__
+        eq, ranged = [], []
+        if qs._where is not None:
+            _compared_fields(qs._where, tab_name, eq, ranged)
+        # equality columns first, then a single range or ordering column
+        cols = list(eq)
+        order = qs._order_by
+        if isinstance(order, Asc):
+            order = order._col
+        extra = ranged[:1] or [order]
+        cols.extend(fld for fld in extra
+            if isinstance(fld, Field) and fld.tab_name == tab_name
+            and not _has_field(cols, fld))
+        self._queries[sql] = [1, tuple(params), tab_name, cols]
+
+    def advice(self):
+        cur = self._store._conn.cursor()
+        rows = {}
+        res = []
+        try:
+            for sql, (count, params, tab_name, cols) in self._queries.items():
+                if not cols:
+                    continue
+                for step in cur.execute("explain query plan " + sql, params).fetchall():
+                    match = self._scan_re.match(step[-1])
+                    if match is None or match.group(1) != tab_name:
+                        continue
+                    if not tab_name in rows:
+                        rows[tab_name] = cur.execute(
+                            "select count(*) from {}".format(tab_name)).fetchone()[0]
+                    if rows[tab_name] < self.min_rows:
+                        continue
+                    index = Index(*cols, name="{}_{}_idx".format(
+                        tab_name, "_".join(fld.self_name for fld in cols)))
+                    res.append(Advice(sql, count, tab_name, rows[tab_name], step[-1], index))
+        finally:
+            cur.close()
+        return res
+
+# a statement run by a store: rows fetched, or changed by writes, and
+# seconds spent running it and building records from its rows
+QueryEvent = collections.namedtuple(
+    "QueryEvent", ["sql", "params", "duration", "rows", "hydration"])
+
+StatementStats = collections.namedtuple(
+    "StatementStats", ["sql", "calls", "total", "max", "rows", "hydration"])
+
+_sql_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_sql_in_list_re = re.compile(r"\bin \(\?(?:, ?\?)*\)", re.I)
+
+# statement text with literals and the length of "in" lists
+# replaced by placeholders, so raw SQL groups like compiled SQL
+def _normalize_sql(sql):
+    sql = " ".join(_sql_literal_re.sub("?", sql).split())
+    return _sql_in_list_re.sub("in (...)", sql)
+
+class QueryStats:
+    '''
+    Store listener adding up the statements run by normalized SQL text,
+    the ones taking more than slow seconds are logged as warnings
+    '''
+    def __init__(self, slow=None, logger=None):
+        self.slow = slow
+        self.logger = logger or logging.getLogger("monkey")
+        # normalized SQL -> [calls, total, max, rows, hydration]
+        self._stats = {}
+
+    def __call__(self, event):
+        sql = _normalize_sql(event.sql)
+        entry = self._stats.get(sql)
+        if entry is None:
+            entry = self._stats[sql] = [0, 0.0, 0.0, 0, 0.0]
+        entry[0] += 1
+        entry[1] += event.duration
+        entry[2] = max(entry[2], event.duration)
+        entry[3] += event.rows
+        entry[4] += event.hydration
+        if self.slow is not None and event.duration >= self.slow:
+            self.logger.warning(
+                "slow query (%.3f s, %d rows): %s",
+                event.duration, event.rows, event.sql)
+
+    # statements taking the most time overall
+    def top(self, n=10):
+        stats = [StatementStats(sql, *entry) for sql, entry in self._stats.items()]
+        stats.sort(key=lambda st: st.total + st.hydration, reverse=True)
+        return stats[:n]
+
+    def report(self, n=10):
+        lines = ["{:>8} {:>10} {:>10} {:>10} {:>10}  {}".format(
+            "calls", "total ms", "max ms", "rows", "hydr ms", "statement")]
+        for st in self.top(n):
+            lines.append("{:>8} {:>10.2f} {:>10.2f} {:>10} {:>10.2f}  {}".format(
+                st.calls, st.total * 1e3, st.max * 1e3, st.rows,
+                st.hydration * 1e3, st.sql))
+        return "\n".join(lines)
+
+    def reset(self):
+        self._stats.clear()
+
+# the innermost frame of the stack outside of this module
+def _caller_frame():
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename not in (__file__, contextlib.__file__):
+            return frame
+    return frame
+
+class RepeatDetector:
+    '''
+    Store listener counting the reads run by normalized SQL, a read run
+    more than limit times is reported once, with a RepeatedQueryWarning
+    pointing at the calling line or by raising RepeatedQuery
+    '''
+    def __init__(self, limit=10, error=False):
+        self.limit = limit
+        self.error = error
+        self.counts = collections.Counter()
+
+    def __call__(self, event):
+        if not Store._read_sql_re.match(event.sql):
+            return
+        sql = _normalize_sql(event.sql)
+        self.counts[sql] += 1
+        count = self.counts[sql]
+        if count != self.limit + 1:
+            return
+        frame = _caller_frame()
+        if self.error:
+            raise RepeatedQuery(sql, count, frame)
+        warnings.warn_explicit(
+            "Query run {} times: {}".format(count, sql),
+            RepeatedQueryWarning, frame.filename, frame.lineno)
+
+    # normalized SQL of the reads run more than limit times
+    def repeated(self):
+        return [(sql, count) for sql, count in self.counts.most_common()
+            if count > self.limit]
 
 class Queryset:
-    def __init__(self, tab_cls, cursor=None, where=None):
-        self._order_by = ""
-        for attr, attr_val in locals().items():
-            setattr(self, "_{}".format(attr), attr_val)
+    # number of rows pulled from the cursor per fetchmany() call
+    chunk_size = 1000
+    # ids bound per prefetch_related() query, the default variable limit of
+    # sqlite builds older than 3.32
+    prefetch_chunk_size = 999
+
+    def __init__(self, tab_cls, cursor=None, where=None, store=None):
+        self._tab_cls = tab_cls
+        self._cursor = cursor
+        self._where = where
+        self._store = store
+        self._order_by = None
+        # selected column names, all of them when None
+        self._fields = None
+        # one of "records", "dicts", "tuples" or "flat"
+        self._result = "records"
+        self._group_by = ()
+        self._limit = None
+        self._offset = None
+        self._select_related = ()
+        self._prefetch_related = ()
+        # where clause before the seek condition of after()
+        self._seek_base = _missing
 
     def set_cursor(self, cursor):
         self._cursor = cursor
 
+    # the cursor given, or the one of the store, which for pooled
+    # stores belongs to the connection of the calling thread
+    @property
+    def _cursor(self):
+        if self._given_cursor is None and self._store is not None:
+            return self._store._cursor
+        return self._given_cursor
+
+    @_cursor.setter
+    def _cursor(self, cursor):
+        self._given_cursor = cursor
+
     def order_by(self, column):
-        if isinstance(column, Field):
-            self._order_by = column.self_name
-        elif isinstance(column, Expr):
-            self._order_by = str(column)
+        if isinstance(column, (Field, Expr, ExprResult)):
+            self._order_by = column
+        return self
 
-    def all(self):
-        # TODO: implement this method as iterator
-        if isinstance(self._where, ExprResult):
-            self._where = "where {}".format(self._where)
+    def _select_fields(self, fields):
+        if fields:
+            self._fields = tuple(fld.self_name for fld in fields)
+        else:
+            self._fields = None
+        return self
+
+    def only(self, *fields):
+        self._select_fields(fields)
+        # records always carry their id, so they can be saved back
+        if self._fields and not "id" in self._fields and "id" in self._tab_cls.columns:
+            self._fields = ("id",) + self._fields
+        self._result = "records"
+        return self
+
+    def values(self, *fields):
+        self._select_fields(fields)
+        self._result = "dicts"
+        return self
+
+    def values_list(self, *fields, flat=False):
+        if flat and len(fields) != 1:
+            raise TypeError("flat values_list() needs exactly one field")
+        self._select_fields(fields)
+        self._result = "flat" if flat else "tuples"
+        return self
+
+    def _columns(self):
+        if self._fields is None:
+            return tuple(self._tab_cls.columns.keys())
+        return self._fields
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def offset(self, n):
+        self._offset = n
+        return self
+
+    # keyset pagination: rows following value in the order of column,
+    # which is used as ordering unless the queryset is already ordered
+    def after(self, column, value):
+        if self._order_by is None:
+            self._order_by = column
+        if isinstance(self._order_by, Desc) and self._order_by._col is column:
+            cond = ExprResult(Lt(column, value))
+        else:
+            cond = ExprResult(Gt(column, value))
+        # the next page replaces the seek condition of the previous one
+        if self._seek_base is _missing:
+            self._seek_base = self._where
+        if self._seek_base is None:
+            self._where = cond
         else:
-            self._where = ""
-        all_recs = self._cursor.execute(
-            "select * from {table} {where} {order_by}".format(
+            self._where = ExprResult(And(self._seek_base, cond))
+        return self
+
+    # slicing returns a limited copy of the queryset, indexing a record
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            if k.step is not None:
+                raise ValueError("Queryset slicing doesn't support steps")
+            start, stop = k.start or 0, k.stop
+            if start < 0 or (stop is not None and stop < 0):
+                raise ValueError("Queryset doesn't support negative indexes")
+            qs = copy.copy(self)
+            qs._offset = (self._offset or 0) + start or None
+            if stop is not None:
+                qs._limit = max(stop - start, 0)
+            if self._limit is not None:
+                left = max(self._limit - start, 0)
+                qs._limit = left if qs._limit is None else min(qs._limit, left)
+            return qs
+        if k < 0:
+            raise ValueError("Queryset doesn't support negative indexes")
+        recs = self[k:k + 1].all()
+        if not recs:
+            raise IndexError("Queryset index out of range")
+        return recs[0]
+
+    def group_by(self, *fields):
+        self._group_by = tuple(fields)
+        return self
+
+    # ForeignKey fields whose records are loaded with a join
+    def select_related(self, *fields):
+        self._select_related = tuple(fields)
+        return self
+
+    # ManyToMany fields whose records are loaded with one extra query
+    # per fetched chunk of records
+    def prefetch_related(self, *fields):
+        self._prefetch_related = tuple(fields)
+        return self
+
+    def _joins(self):
+        # related records are only built along with records
+        if self._result != "records":
+            return ()
+        return self._select_related
+
+    # selected expressions are walked before the where clause and the
+    # ordering, so that parameters are collected in the order they appear
+    # in the SQL
+    def _statement(self, kind, params, build, select=()):
+        # the ordering is only rendered by selects, pages and groups
+        ordered = kind == "select" or self._limited() or (
+            kind == "aggregate" and self._group_by)
+        # SQL text is cached per store by the shape of the query, so the
+        # same query with other values reuses sqlite's prepared statement
+        key = (
+            kind,
+            self._tab_cls,
+            self._fields,
+            self._result,
+            tuple(fld.self_name for fld in self._joins()),
+            tuple(_shape(expr, params) for expr in select),
+            _shape(self._where, params) if self._where is not None else None,
+            tuple(fld.self_name for fld in self._group_by),
+            _shape(self._order_by, params if ordered else [])
+                if self._order_by is not None else None,
+            self._limit is not None,
+            self._offset is not None)
+        if self._store is None:
+            return build()
+        return self._store._statement(key, build)
+
+    # related tables are joined under their own name, so that filters can
+    # use their fields, unless the query already has a table of that name
+    # (several foreign keys to one table), then under the name of the key
+    def _join_aliases(self):
+        names = {self._tab_cls.__table__}
+        aliases = []
+        for fld in self._joins():
+            alias = fld.dependent_tab.__table__
+            if alias in names:
+                alias = "{}_{}".format(fld.tab_name, fld.self_name)
+            names.add(alias)
+            aliases.append((fld, alias))
+        return aliases
+
+    def _join_sql(self):
+        joins = []
+        for fld, alias in self._join_aliases():
+            rel = fld.dependent_tab.__table__
+            joins.append("left join {rel}{as_alias} on {alias}.id = {fk}".format(
+                rel=rel,
+                as_alias="" if alias == rel else " as " + alias,
+                alias=alias,
+                fk=fld.qual_name))
+        return " ".join(joins)
+
+    def _select_cols_sql(self):
+        table = self._tab_cls.__table__
+        cols = ["{}.{}".format(table, k) for k in self._columns()]
+        for fld, alias in self._join_aliases():
+            cols.extend("{}.{}".format(alias, k)
+                for k in fld.dependent_tab.columns)
+        return ", ".join(cols)
+
+    def _where_sql(self):
+        if self._where is None:
+            return ""
+        return "where {}".format(self._where)
+
+    def _group_by_sql(self):
+        if not self._group_by:
+            return ""
+        return "group by {}".format(
+            ", ".join(_sql(fld) for fld in self._group_by))
+
+    def _order_by_sql(self):
+        if self._order_by is None:
+            return ""
+        return "order by {}".format(_sql(self._order_by))
+
+    def _limited(self):
+        return self._limit is not None or self._offset is not None
+
+    def _limit_sql(self, params):
+        if not self._limited():
+            return ""
+        params.append(-1 if self._limit is None else self._limit)
+        if self._offset is None:
+            return "limit ?"
+        params.append(self._offset)
+        return "limit ? offset ?"
+
+    # the rows counted and aggregated: the filtered table, or the page
+    # of it in a subquery when the queryset is limited, unless the page
+    # is one of groups
+    def _from_sql(self, paged=True):
+        table = self._tab_cls.__table__
+        if not (paged and self._limited()):
+            return "{table} {joins} {where}".format(
+                table=table,
+                joins=self._join_sql(),
+                where=self._where_sql())
+        return "(select {table}.* from {table} {joins} {where} {order_by} {limit}) as {table}".format(
+            table=table,
+            joins=self._join_sql(),
+            where=self._where_sql(),
+            order_by=self._order_by_sql(),
+            limit=self._limit_sql([]))
+
+    def _select_sql(self):
+        params = []
+        sql = self._statement("select", params, lambda: (
+            "select {cols} from {table} {joins} {where} {order_by} {limit}".format(
+                cols=self._select_cols_sql(),
                 table=self._tab_cls.__table__,
-                where=self._where,
-                order_by=self._order_by
-                ).strip()).fetchall()
-        return [self._tab_cls.fromtuple(rec) for rec in all_recs]
+                joins=self._join_sql(),
+                where=self._where_sql(),
+                order_by=self._order_by_sql(),
+                limit=self._limit_sql([])
+                ).strip()))
+        self._limit_sql(params)
+        return sql, tuple(params)
+
+    def count(self):
+        params = []
+        sql = self._statement("count", params, lambda: (
+            "select count(*) from {source}".format(
+                source=self._from_sql()
+                ).strip()))
+        self._limit_sql(params)
+        return self._fetchall(sql, params)[0][0]
+
+    def exists(self):
+        params = []
+        sql = self._statement("exists", params, lambda: (
+            "select 1 from {source} limit 1".format(
+                source=self._from_sql()
+                )))
+        self._limit_sql(params)
+        return len(self._fetchall(sql, params)) > 0
+
+    # without group_by() returns a tuple of the aggregated values, with it
+    # a list of tuples holding the group columns followed by the values
+    def aggregate(self, *aggs):
+        params = []
+        select = self._group_by + aggs
+        grouped = bool(self._group_by)
+        sql = self._statement("aggregate", params, lambda: (
+            "select {cols} from {source} {group_by} {order_by} {limit}".format(
+                cols=", ".join(_sql(expr) for expr in select),
+                source=self._from_sql(paged=not grouped),
+                group_by=self._group_by_sql(),
+                order_by=self._order_by_sql() if grouped else "",
+                limit=self._limit_sql([]) if grouped else ""
+                ).strip()), select=aggs)
+        self._limit_sql(params)
+        rows = self._fetchall(sql, params)
+        if self._group_by:
+            return rows
+        return rows[0]
+
+    # limited querysets can't be deleted or updated directly,
+    # their rows are picked by id in a subquery instead
+    def _write_where_sql(self):
+        if not self._limited():
+            return self._where_sql()
+        return "where id in (select id from {table} {where} {order_by} {limit})".format(
+            table=self._tab_cls.__table__,
+            where=self._where_sql(),
+            order_by=self._order_by_sql(),
+            limit=self._limit_sql([]))
+
+    def delete(self):
+        params = []
+        sql = self._statement("delete", params, lambda: (
+            "delete from {table} {where}".format(
+                table=self._tab_cls.__table__,
+                where=self._write_where_sql()
+                ).strip()))
+        self._limit_sql(params)
+        count = self._execute(sql, params)
+        if self._store is not None:
+            self._store._evict(self._tab_cls)
+            self._store._invalidate(self._tab_cls.__table__)
+        return count
+
+    # values are plain values or expressions, e.g. Tab.counter + 1
+    def update(self, **kwargs):
+        columns = self._tab_cls.columns
+        for k in kwargs.keys():
+            if not k in columns:
+                raise UnknownTableColumn(k)
+        names = tuple(kwargs.keys())
+        values = tuple(kwargs.values())
+        params = []
+        sql = self._statement(("update", names), params, lambda: (
+            "update {table} set {values} {where}".format(
+                table=self._tab_cls.__table__,
+                values=", ".join("{} = {}".format(k, _sql(v))
+                    for k, v in zip(names, values)),
+                where=self._write_where_sql()
+                ).strip()), select=values)
+        self._limit_sql(params)
+        count = self._execute(sql, params)
+        if self._store is not None:
+            self._store._evict(self._tab_cls)
+            self._store._invalidate(self._tab_cls.__table__)
+        return count
+
+    # returns the function applied to every fetched row, None when rows
+    # are returned as they come from the cursor
+    def _converter(self):
+        result = self._result
+        if result == "records":
+            if self._fields is None:
+                fromtuple = self._identity_fromtuple(self._tab_cls)
+            elif self._store is None:
+                fromtuple = _hydrators(self._tab_cls, self._fields)[0]
+            else:
+                fromtuple = self._store._statement(
+                    ("fromtuple", self._tab_cls, self._fields),
+                    lambda: _hydrators(self._tab_cls, self._fields)[0])
+            if not self._joins():
+                return fromtuple
+            return self._join_converter(fromtuple)
+        if result == "dicts":
+            cols = self._columns()
+            return lambda row: dict(zip(cols, row))
+        if result == "flat":
+            return operator.itemgetter(0)
+        return None
+
+    def _identity_fromtuple(self, table_cls):
+        if self._store is None or self._store._identity is None:
+            return table_cls.fromtuple
+        return self._store._identity_fromtuple(table_cls)
+
+    # splits joined rows into the record and its related records, the
+    # related record is None when the foreign key matched no row
+    def _join_converter(self, fromtuple):
+        width = len(self._columns())
+        parts = []
+        begin = width
+        for fld in self._joins():
+            rel_cls = fld.dependent_tab
+            end = begin + len(rel_cls.columns)
+            id_pos = begin + list(rel_cls.columns).index("id")
+            parts.append((
+                fld.self_name, self._identity_fromtuple(rel_cls),
+                begin, end, id_pos))
+            begin = end
+
+        def convert(row):
+            inst = fromtuple(row[:width])
+            if inst._related is None:
+                inst._related = {}
+            related = inst._related
+            for name, rel_fromtuple, begin, end, id_pos in parts:
+                if row[id_pos] is None:
+                    related[name] = None
+                else:
+                    related[name] = rel_fromtuple(row[begin:end])
+            return inst
+        return convert
+
+    def _prefetch(self, recs):
+        by_id = {}
+        for rec in recs:
+            if rec._related is None:
+                rec._related = {}
+            by_id.setdefault(rec.id, []).append(rec)
+        ids = list(by_id)
+        max_params = self.prefetch_chunk_size
+        for fld in self._prefetch_related:
+            name = fld.self_name
+            rel_cls = fld.dependent_tab
+            rel_fromtuple = self._identity_fromtuple(rel_cls)
+            for rec in recs:
+                rec._related[name] = []
+            for i in range(0, len(ids), max_params):
+                chunk = ids[i:i + max_params]
+                sql = (
+                    "select {link}.{tab}_id, {cols} from {rel} "
+                    "join {link} on {link}.{rel}_id = {rel}.id "
+                    "where {link}.{tab}_id in ({ids_phs})").format(
+                    link=fld.link_tab_name,
+                    tab=fld.tab_name,
+                    rel=rel_cls.__table__,
+                    cols=", ".join("{}.{}".format(rel_cls.__table__, k)
+                        for k in rel_cls.columns),
+                    ids_phs=",".join(["?" for _ in chunk]))
+                for row in self._fetchall_uncached(sql, chunk):
+                    rel = rel_fromtuple(row[1:])
+                    for rec in by_id[row[0]]:
+                        rec._related[name].append(rel)
+
+    def _tables(self):
+        return (self._tab_cls.__table__,) + tuple(
+            fld.dependent_tab.__table__ for fld in self._joins())
+
+    # fetches all rows of a statement, through the store's result cache
+    # when it has one
+    def _fetchall(self, sql, params):
+        cache = self._store._cache if self._store is not None else None
+        if cache is None:
+            self._advise(sql, params)
+            return self._fetchall_uncached(sql, params)
+        key = (sql, tuple(params))
+        try:
+            hash(key)
+        except (TypeError, ValueError):
+            # bytearray or writable memoryview parameters can't be cache keys
+            self._advise(sql, params)
+            return self._fetchall_uncached(sql, params)
+        rows = cache.get(key)
+        if rows is None:
+            version = cache.version
+            self._advise(sql, params)
+            rows = self._fetchall_uncached(sql, params)
+            cache.put(key, self._tables(), rows, version)
+        return rows
+
+    def _fetchall_uncached(self, sql, params):
+        if self._store is None:
+            return self._cursor.execute(sql, params).fetchall()
+        return self._store._fetchall(self._cursor, sql, params)
+
+    # runs a write and returns the number of changed rows
+    def _execute(self, sql, params):
+        self._advise(sql, params)
+        if self._store is None:
+            return self._cursor.execute(sql, params).rowcount
+        return self._store._run_write(sql, params)
+
+    def _advise(self, sql, params):
+        if self._store is not None and self._store._advisor is not None:
+            self._store._advisor.record(self, sql, params)
+
+    # sqlite's plan of the statement run by all()
+    def explain(self):
+        sql, params = self._select_sql()
+        return [PlanStep(row[0], row[1], row[-1]) for row in
+            self._cursor.execute("explain query plan " + sql, params).fetchall()]
+
+    def _build(self, rows, convert, prefetch):
+        if convert is None:
+            return rows
+        if prefetch:
+            recs = list(map(convert, rows))
+            self._prefetch(recs)
+            return recs
+        return map(convert, rows)
+
+    def iterator(self, chunk_size=None):
+        chunk_size = chunk_size or self.chunk_size
+        convert = self._converter()
+        prefetch = self._result == "records" and self._prefetch_related
+        sql, params = self._select_sql()
+        self._advise(sql, params)
+        # use a dedicated cursor, so statements issued while iterating
+        # don't reset the result set of the shared one
+        cur = self._cursor.connection.cursor()
+        try:
+            if self._store is None or not self._store._listeners:
+                cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield from self._build(rows, convert, prefetch)
+                return
+            yield from self._timed_iterator(cur, sql, params, chunk_size, convert, prefetch)
+        finally:
+            cur.close()
+
+    # iterator() reporting to the store listeners once the iteration
+    # ends, chunks are built before being yielded to time hydration
+    def _timed_iterator(self, cur, sql, params, chunk_size, convert, prefetch):
+        duration = hydration = 0.0
+        count = 0
+        try:
+            start = time.perf_counter()
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                built = time.perf_counter()
+                duration += built - start
+                if not rows:
+                    break
+                count += len(rows)
+                recs = list(self._build(rows, convert, prefetch))
+                start = time.perf_counter()
+                hydration += start - built
+                yield from recs
+                start = time.perf_counter()
+        finally:
+            self._store._emit(sql, params, duration, count, hydration)
+
+    def __iter__(self):
+        return self.iterator()
+
+    def all(self):
+        if self._store is None or self._store._cache is None:
+            return list(self.iterator())
+        rows = self._fetchall(*self._select_sql())
+        prefetch = self._result == "records" and self._prefetch_related
+        return list(self._build(rows, self._converter(), prefetch))
+
+    # splits the scan in rowid ranges read by a pool of worker processes,
+    # each on a read-only connection of its own. Rows are built there and
+    # passed to map() when given. Without reduce() the results are
+    # yielded partition after partition, in rowid order. With it each
+    # process folds its partition with reduce(acc, value), starting from
+    # initial, or from its first value when there's none, then the
+    # partial results are merged here with combine(acc, part), which
+    # defaults to reduce without initial and is required with it.
+    # Table classes and functions must be importable by the workers.
+    def parallel(self, workers=None, map=None, reduce=None, initial=_missing,
+            combine=None, partitions=None):
+        has_initial = initial is not _missing
+        store = self._store
+        if store is None or store.db == ":memory:" or store.db.startswith("file:"):
+            raise ValueError("parallel() needs a store on a database file")
+        if self._limited() or self._joins() or self._prefetch_related or self._group_by:
+            raise ValueError("parallel() can't scan limited, grouped or related querysets")
+        # partitions are read in rowid order, each one sorted on its own
+        if self._order_by is not None:
+            raise ValueError("parallel() can't scan ordered querysets")
+        if reduce is not None and combine is None:
+            if has_initial:
+                raise ValueError("parallel() needs combine() to merge partitions folded from initial")
+            combine = reduce
+        workers = workers or os.cpu_count()
+        table = self._tab_cls.__table__
+        low, high = store.raw("select min(rowid), max(rowid) from {}".format(table))[0]
+        where, where_params = ("", ())
+        if self._where is not None:
+            where, where_params = self._where.compile()
+            where = "and ({})".format(where)
+        sql = "select {cols} from {table} where {table}.rowid between ? and ? {where}".format(
+            cols=self._select_cols_sql(),
+            table=table,
+            where=where)
+        ranges = []
+        if low is not None:
+            count = min(partitions or workers * 4, high - low + 1)
+            step = (high - low + 1) / count
+            bounds = [low + int(step * i) for i in range(count)] + [high + 1]
+            ranges = [(lo, hi - 1) for lo, hi in zip(bounds, bounds[1:])]
+        uri = pathlib.Path(store.db).absolute().as_uri() + "?mode=ro"
+        # the marker of a missing initial value wouldn't survive pickling
+        tasks = [
+            (uri, sql, (lo, hi) + tuple(where_params), self._tab_cls,
+                self._fields, self._result, map, reduce,
+                initial if has_initial else None, has_initial)
+            for lo, hi in ranges]
+        if reduce is None:
+            return self._parallel_stream(workers, tasks)
+        with ProcessPoolExecutor(workers) as executor:
+            parts = [value for found, value in executor.map(_scan_partition, tasks)
+                if found]
+        if not parts:
+            if has_initial:
+                return initial
+            raise ValueError("parallel() reduced an empty scan without initial")
+        return functools.reduce(combine, parts)
+
+    def _parallel_stream(self, workers, tasks):
+        executor = ProcessPoolExecutor(workers)
+        try:
+            for values in executor.map(_scan_partition, tasks):
+                yield from values
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+# runs on the worker processes of Queryset.parallel()
+def _scan_partition(task):
+    uri, sql, params, table_cls, fields, result, map_fn, reduce_fn, initial, has_initial = task
+    conn = sqlite3.connect(uri, uri=True)
+    try:
+        qs = Queryset(table_cls)
+        qs._fields = fields
+        qs._result = result
+        convert = qs._converter()
+        values = conn.execute(sql, params)
+        if convert is not None:
+            values = map(convert, values)
+        if map_fn is not None:
+            values = map(map_fn, values)
+        if reduce_fn is None:
+            return list(values)
+        if not has_initial:
+            values = iter(values)
+            for initial in values:
+                break
+            else:
+                return False, None
+        return True, functools.reduce(reduce_fn, values, initial)
+    finally:
+        conn.close()
+
+class _UndoLog(dict):
+    '''
+    State of the records written by a transaction before it first touched
+    them, by record id. Records are weakly referenced and forgotten once the
+    caller drops them, so bulk writes never keep their input alive
+    '''
+    def remember(self, tab_inst, state):
+        key = id(tab_inst)
+        if key not in self:
+            self[key] = (
+                weakref.ref(tab_inst, functools.partial(self._forget, key)),
+                state)
+
+    def _forget(self, key, ref):
+        if key in self and self[key][0] is ref:
+            del self[key]
+
+    def merge(self, other):
+        for tab_inst, state in other.records():
+            self.remember(tab_inst, state)
+
+    def records(self):
+        for ref, state in list(self.values()):
+            tab_inst = ref()
+            if tab_inst is not None:
+                yield tab_inst, state
 
 class Store:
-    def __init__(self, db_string):
+    # max number of distinct statements kept in the SQL text cache
+    statement_cache_size = 256
+    # statement opening the outermost transaction
+    _begin_sql = "begin"
+
+    def __init__(self, db_string, identity_map=False,
+            cache_size=0, cache_ttl=None):
         match = re.search("(.+)://(.+)", db_string)
         self.engine = match.group(1)
-        self.db = db = match.group(2)
+        self.db = match.group(2)
         # TODO: do abstraction to use arbitrary engine, not only sqlite
-        self._conn = conn = sqlite3.connect(db)
-        self._cursor = cur = conn.cursor()
-        cur.execute("pragma foreign_keys = on")
+        self._open()
+        self._statements = {}
+        # IndexAdvisor of the running advise() block
+        self._advisor = None
+        # callables receiving a QueryEvent for every statement run
+        self._listeners = []
+        # WriteBehind buffering the added records, see write_behind()
+        self._buffer = None
+        # records by (table class, id), rows loaded again while a record
+        # is alive return that record instead of a new one
+        if identity_map:
+            self._identity = weakref.WeakValueDictionary()
+        else:
+            self._identity = None
+        # results of Queryset.all() and of counts and aggregates
+        if cache_size:
+            self._cache = ResultCache(cache_size, cache_ttl)
+        else:
+            self._cache = None
+
+    def _connect(self, db, uri=False):
+        # autocommit mode, transactions are opened by Store.transaction()
+        conn = sqlite3.connect(
+            db, cached_statements=self.statement_cache_size,
+            isolation_level=None, check_same_thread=False, uri=uri)
+        conn.execute("pragma foreign_keys = on")
+        return conn
+
+    def _open(self):
+        self._conn = conn = self._connect(self.db)
+        self._cursor = conn.cursor()
+        self._tx_depth = 0
+        self._work = None
+        # records states to put back on rollback, None out of transactions
+        self._undo = None
+        self._written = None
+
+    def close(self):
+        self._conn.close()
+
+    def cache_info(self):
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
+    # drops cached results when their tables are written, and once more
+    # when the transaction commits, as other connections may have read
+    # the committed rows in between
+    def _invalidate(self, *tables):
+        if self._cache is not None:
+            self._cache.invalidate(*tables)
+            if self._tx_depth:
+                self._written.update(tables or (None,))
+
+    def _identity_fromtuple(self, table_cls):
+        identity = self._identity
+        fromtuple = table_cls.fromtuple
+        if not "id" in table_cls.columns:
+            return fromtuple
+        id_pos = list(table_cls.columns).index("id")
+
+        def identity_fromtuple(row):
+            key = (table_cls, row[id_pos])
+            inst = identity.get(key)
+            if inst is None:
+                inst = identity[key] = fromtuple(row)
+            return inst
+        return identity_fromtuple
+
+    # forgets the records of a table changed by bulk statements
+    def _evict(self, table_cls):
+        if self._identity is None:
+            return
+        for key in list(self._identity.keys()):
+            if key[0] is table_cls:
+                self._identity.pop(key, None)
+
+    def _evict_table(self, table):
+        if self._identity is None:
+            return
+        table = table.lower()
+        for key in list(self._identity.keys()):
+            if key[0].__table__.lower() == table:
+                self._identity.pop(key, None)
+
+    def _statement(self, key, build):
+        try:
+            return self._statements[key]
+        except KeyError:
+            pass
+        if len(self._statements) >= self.statement_cache_size:
+            self._statements.clear()
+        sql = self._statements[key] = build()
+        return sql
+
+    @contextlib.contextmanager
+    def transaction(self):
+        depth = self._tx_depth
+        # nested transactions are savepoints inside the outermost one
+        if depth:
+            self._execute(self._cursor, "savepoint sp{}".format(depth))
+        else:
+            self._execute(self._cursor, self._begin_sql)
+            # tables written by the transaction
+            self._written = set()
+        self._tx_depth = depth + 1
+        outer_undo = self._undo
+        self._undo = undo = _UndoLog()
+        try:
+            yield self
+            if not depth:
+                # a failing commit (deferred constraints, busy database)
+                # is rolled back like a failing body
+                self._execute(self._cursor, "commit")
+        except BaseException:
+            self._tx_depth = depth
+            self._undo = outer_undo
+            if depth:
+                self._execute(self._cursor, "rollback to sp{}".format(depth))
+                self._execute(self._cursor, "release sp{}".format(depth))
+            elif self._conn.in_transaction:
+                self._execute(self._cursor, "rollback")
+            self._restore(undo)
+            # results cached and records loaded inside the transaction
+            # may be gone
+            self._invalidate()
+            if self._identity is not None:
+                self._identity.clear()
+            raise
+        self._tx_depth = depth
+        self._undo = outer_undo
+        if depth:
+            self._execute(self._cursor, "release sp{}".format(depth))
+            # the outer transaction may still be rolled back
+            outer_undo.merge(undo)
+        else:
+            written, self._written = self._written, None
+            if written:
+                self._invalidate(*(() if None in written else written))
+
+    # keeps the state of a record about to be written by the running
+    # transaction, to put it back if the transaction is rolled back
+    def _remember(self, tab_inst):
+        if self._undo is not None:
+            self._undo.remember(tab_inst, (
+                getattr(tab_inst, "_id", _missing),
+                tab_inst._dirty, tab_inst._persisted))
+
+    def _restore(self, undo):
+        for tab_inst, (id_val, dirty, persisted) in undo.records():
+            if id_val is not _missing:
+                tab_inst._id = id_val
+            tab_inst._dirty = dirty
+            tab_inst._persisted = persisted
+
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        # nested units of work are merged into the outermost one
+        if self._work is not None:
+            yield self
+            return
+        self._work = work = []
+        try:
+            yield self
+        finally:
+            self._work = None
+        self._flush_work(work)
+
+    def _flush_work(self, work):
+        with self.transaction():
+            for (op, conflict_col), items in itertools.groupby(
+                    work, key=lambda item: item[0]):
+                # the same record queued twice is written once
+                insts = collections.OrderedDict(
+                    (id(inst), inst) for _, inst in items).values()
+                if op == "add":
+                    self._add_many(insts, conflict_col=conflict_col)
+                else:
+                    self.delete_many(insts)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
 
-    def raw(self, sql):
-        return self._cursor.execute(sql).fetchall()
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    # statistics of the statements run inside the block
+    @contextlib.contextmanager
+    def profile(self, slow=None, logger=None):
+        stats = QueryStats(slow, logger)
+        self.add_listener(stats)
+        try:
+            yield stats
+        finally:
+            self.remove_listener(stats)
+
+    # reports reads of the same shape run more than limit times inside
+    # the block, typically one query per record of a loop (N+1 queries)
+    @contextlib.contextmanager
+    def detect_repeats(self, limit=10, error=False):
+        detector = RepeatDetector(limit, error)
+        self.add_listener(detector)
+        try:
+            yield detector
+        finally:
+            self.remove_listener(detector)
+
+    def _emit(self, sql, params, duration, rows, hydration=0.0):
+        event = QueryEvent(sql, params, duration, rows, hydration)
+        for listener in self._listeners:
+            listener(event)
+
+    # all statements of the store are run by _execute() and _fetchall(),
+    # which report them to the listeners
+    def _execute(self, cur, sql, params=(), many=False):
+        run = cur.executemany if many else cur.execute
+        if not self._listeners:
+            return run(sql, params)
+        start = time.perf_counter()
+        run(sql, params)
+        self._emit(sql, params, time.perf_counter() - start, max(cur.rowcount, 0))
+        return cur
+
+    def _run_write(self, sql, params=()):
+        return self._execute(self._cursor, sql, params).rowcount
+
+    def _fetchall(self, cur, sql, params=()):
+        if not self._listeners:
+            return cur.execute(sql, params).fetchall()
+        start = time.perf_counter()
+        rows = cur.execute(sql, params).fetchall()
+        self._emit(sql, params, time.perf_counter() - start, len(rows))
+        return rows
+
+    # records the querysets run inside the block, the advisor yielded
+    # tells which of them scan large tables and what index would help
+    @contextlib.contextmanager
+    def advise(self, min_rows=1000):
+        prev = self._advisor
+        self._advisor = advisor = IndexAdvisor(self, min_rows)
+        try:
+            yield advisor
+        finally:
+            self._advisor = prev
+
+    # records added from now on are buffered and written in the
+    # background, see WriteBehind
+    def write_behind(self, batch_size=1000, interval=1.0, max_pending=100000):
+        if self._buffer is not None:
+            raise ValueError("Store is already in write-behind mode")
+        self._buffer = WriteBehind(self, batch_size, interval, max_pending)
+        return self._buffer
+
+    def raw(self, sql, params=(), table_cls=None):
+        if self._cache is not None or self._identity is not None:
+            self._invalidate_raw(sql)
+        if table_cls is None:
+            return self._fetchall(self._cursor, sql, params)
+        cur = self._conn.cursor()
+        cur.row_factory = table_cls.row_factory
+        try:
+            return self._fetchall(cur, sql, params)
+        finally:
+            cur.close()
 
     __truediv__ = raw
 
+    _read_sql_re = re.compile(r"\s*(select|explain)\b", re.I)
+    _write_sql_re = re.compile(
+        r"\s*(?:insert(?:\s+or\s+\w+)?\s+into|replace\s+into|"
+        r"update(?:\s+or\s+\w+)?|delete\s+from)\s+"
+        r"(?:[\"'`\[]?\w+[\"'`\]]?\.)?[\"'`\[]?(\w+)", re.I)
+
+    # raw writes drop the cached results and records of their table, any
+    # other statement that is not a plain read drops all of them
+    def _invalidate_raw(self, sql):
+        if self._read_sql_re.match(sql):
+            return
+        match = self._write_sql_re.match(sql)
+        if match is None:
+            self._invalidate()
+            if self._identity is not None:
+                self._identity.clear()
+        else:
+            table = match.group(1)
+            self._invalidate(table)
+            self._evict_table(table)
+
     # TODO: finish m2m tables
     def _create_m2m_table(self, table_cls):
         for attr, attr_cls in table_cls.__dict__.items():
             if isinstance(attr_cls, ManyToMany):
-                self._cursor.execute(
+                self._execute(self._cursor,
                     "create table if not exists {fst_tab}_{snd_tab} "
                     "({fst_tab}_id,{snd_tab}_id,"
                     "foreign key({fst_tab}_id) references {fst_tab}(id) on delete cascade,"
@@ -409,42 +1941,846 @@ class Store:
                     )
 
     def create_table(self, table_cls):
-        self._cursor.execute(
+        self._execute(self._cursor,
             "create table if not exists {table} ({fld_defs})".format(
                 table=table_cls.__table__,
                 fld_defs=table_cls.field_defs
                 ))
+        for index in table_cls.indexes:
+            self._execute(self._cursor, index.sql(table_cls.__table__))
         self._create_m2m_table(table_cls)
 
     # store << Table_class is the same as store.create_table(Table_class)
     __lshift__ = create_table
 
-    def add(self, tab_inst):
-        with_id = False
-        if tab_inst.updated and isinstance(tab_inst.id, int):
-            with_id = True
-        values = tab_inst.values(with_id)
-        self._cursor.execute(
-            "insert or replace into {table} ({cols}) values ({values_phs})".format(
-                table=tab_inst.__class__.__table__,
-                cols=", ".join(tab_inst.keys(with_id)),
-                values_phs=",".join(["?" for _ in values])
+    def _insert_cols(self, table_cls, with_id):
+        return self._statement(
+            ("insert cols", table_cls, with_id),
+            lambda: tuple(k for k in table_cls.columns.keys()
+                if with_id or k != "id"))
+
+    def _values_getter(self, table_cls, cols):
+        return self._statement(
+            ("values", table_cls, cols), lambda: _values_getter(cols))
+
+    def _write_sql(self, key):
+        def build():
+            kind, table_cls, arg = key
+            if kind == "update":
+                return "update {table} set {cols} where id = ?".format(
+                    table=table_cls.__table__,
+                    cols=", ".join("{} = ?".format(k) for k in arg))
+            if kind == "upsert":
+                with_id, conflict_col = arg
+                cols = self._insert_cols(table_cls, with_id)
+                # the conflict column itself is assigned when there is
+                # nothing else to update, so the row is always returned
+                update_cols = [k for k in cols
+                    if k != conflict_col and k != "id"] or [conflict_col]
+                return (
+                    "insert into {table} ({cols}) values ({values_phs}) "
+                    "on conflict({conflict_col}) do update set {updates}").format(
+                    table=table_cls.__table__,
+                    cols=", ".join(cols),
+                    values_phs=",".join(["?" for _ in cols]),
+                    conflict_col=conflict_col,
+                    updates=", ".join(
+                        "{0} = excluded.{0}".format(k) for k in update_cols))
+            cols = self._insert_cols(table_cls, arg)
+            if not cols:
+                return "insert into {table} default values".format(
+                    table=table_cls.__table__)
+            return "insert into {table} ({cols}) values ({values_phs})".format(
+                table=table_cls.__table__,
+                cols=", ".join(cols),
+                values_phs=",".join(["?" for _ in cols])
                 )
-            , tuple(values))
-        if not with_id:
-            tab_inst.id = tab_inst.columns["id"] = self._cursor.lastrowid
-        tab_inst.updated = False
+        return self._statement(key, build)
+
+    def _conflict_col(self, upsert):
+        if upsert is None or upsert is False:
+            return None
+        if upsert is True:
+            return "id"
+        props = upsert.allowed_props
+        if not (props["unique"] or props["primary_key"]):
+            raise NotUniqueField(upsert.self_name)
+        return upsert.self_name
+
+    # returns the statement key and parameters needed to save a record,
+    # or None when a loaded record has no changes
+    def _write(self, tab_inst, conflict_col=None):
+        table_cls = tab_inst.__class__
+        changed = tab_inst._changed()
+        if tab_inst._persisted and "id" not in changed:
+            if not changed:
+                return None
+            params = list(self._values_getter(table_cls, changed)(tab_inst))
+            params.append(tab_inst.id)
+            return ("update", table_cls, changed), params
+        with_id = tab_inst.id is not None
+        # a record with an explicit id updates the row it collides with
+        # in place, instead of deleting and reinserting it
+        if with_id and conflict_col is None:
+            conflict_col = "id"
+        params = self._values_getter(
+            table_cls, self._insert_cols(table_cls, with_id))(tab_inst)
+        if conflict_col is None:
+            return ("insert", table_cls, False), params
+        return ("upsert", table_cls, (with_id, conflict_col)), params
+
+    def _saved(self, tab_inst):
+        self._invalidate(tab_inst.__class__.__table__)
+        tab_inst._dirty = 0
+        tab_inst._persisted = True
+        if self._identity is not None and tab_inst.id is not None:
+            self._identity[(tab_inst.__class__, tab_inst.id)] = tab_inst
+
+    def add(self, tab_inst, upsert=None):
+        if (self._buffer is not None and upsert is None
+                and self._work is None and not self._tx_depth):
+            self._buffer.put(tab_inst)
+            return
+        conflict_col = self._conflict_col(upsert)
+        if self._work is not None:
+            self._work.append((("add", conflict_col), tab_inst))
+            return
+        write = self._write(tab_inst, conflict_col)
+        self._remember(tab_inst)
+        if write is not None:
+            key, params = write
+            kind, table_cls, arg = key
+            if kind == "insert":
+                self._execute(self._cursor, self._write_sql(key), params)
+                tab_inst.id = self._cursor.lastrowid
+            elif kind == "upsert" and (not arg[0] or arg[1] != "id"):
+                # the row updated on a unique field conflict keeps its own
+                # id, which the record may not have or may have wrong
+                sql = self._statement(
+                    key + ("returning",),
+                    lambda: self._write_sql(key) + " returning id")
+                tab_inst.id = self._fetchall(self._cursor, sql, params)[0][0]
+            else:
+                self._execute(self._cursor, self._write_sql(key), params)
+        self._saved(tab_inst)
+
+    def add_many(self, tab_insts, batch_size=1000, upsert=None):
+        return self._add_many(
+            tab_insts, batch_size, self._conflict_col(upsert))
+
+    def _add_many(self, tab_insts, batch_size=1000, conflict_col=None):
+        count = 0
+        tab_insts = iter(tab_insts)
+        with self.transaction():
+            while True:
+                batch = list(itertools.islice(tab_insts, batch_size))
+                if not batch:
+                    break
+                groups = collections.OrderedDict()
+                for tab_inst in batch:
+                    self._remember(tab_inst)
+                    write = self._write(tab_inst, conflict_col)
+                    if write is None:
+                        continue
+                    key, params = write
+                    insts, rows = groups.setdefault(key, ([], []))
+                    insts.append(tab_inst)
+                    rows.append(params)
+                for key, (insts, rows) in groups.items():
+                    self._execute(self._cursor, self._write_sql(key), rows, many=True)
+                    kind, table_cls, arg = key
+                    if kind == "insert":
+                        # rows inserted by one statement without explicit
+                        # ids get consecutive rowids ending with the last one
+                        last_id = self._fetchall(
+                            self._cursor, "select last_insert_rowid()")[0][0]
+                        for rowid, inst in enumerate(insts, last_id - len(insts) + 1):
+                            inst.id = rowid
+                    elif kind == "upsert" and (not arg[0] or arg[1] != "id"):
+                        self._fetch_ids(table_cls, arg[1], insts)
+                for tab_inst in batch:
+                    self._saved(tab_inst)
+                count += len(batch)
+        return count
+
+    # executemany() drops rows produced by "returning", so ids of upserted
+    # records are looked up by their conflict column values instead
+    def _fetch_ids(self, table_cls, col, insts, chunk_size=500):
+        for i in range(0, len(insts), chunk_size):
+            chunk = insts[i:i + chunk_size]
+            ids = dict(self._fetchall(self._cursor,
+                "select {col}, id from {table} where {col} in ({values_phs})".format(
+                    col=col,
+                    table=table_cls.__table__,
+                    values_phs=",".join(["?" for _ in chunk])),
+                [getattr(inst, col) for inst in chunk]))
+            for inst in chunk:
+                inst.id = ids.get(getattr(inst, col))
 
     # + operator
     __add__ = __radd__ = add
 
+    def _delete_sql(self, table_cls):
+        return self._statement(
+            ("delete", table_cls),
+            lambda: "delete from {table} where id = ?".format(
+                table=table_cls.__table__))
+
     def delete(self, tab_inst):
-        self._cursor.execute("delete from {table} where id = ?".format(
-            table=tab_inst.__class__.__table__
-            ), (tab_inst.id,))
+        if self._work is not None:
+            self._work.append((("delete", None), tab_inst))
+            return
+        self._execute(self._cursor,
+            self._delete_sql(tab_inst.__class__), (tab_inst.id,))
+        self._deleted(tab_inst)
+
+    def delete_many(self, tab_insts):
+        groups = collections.OrderedDict()
+        for tab_inst in tab_insts:
+            groups.setdefault(tab_inst.__class__, []).append(tab_inst)
+        with self.transaction():
+            for table_cls, insts in groups.items():
+                self._execute(self._cursor,
+                    self._delete_sql(table_cls),
+                    [(inst.id,) for inst in insts], many=True)
+        for insts in groups.values():
+            for inst in insts:
+                self._deleted(inst)
+
+    def _deleted(self, tab_inst):
+        self._remember(tab_inst)
+        self._invalidate(tab_inst.__class__.__table__)
+        tab_inst._persisted = False
+        if self._identity is not None:
+            self._identity.pop((tab_inst.__class__, tab_inst.id), None)
 
     # - operator
     __sub__ = delete
 
     def __call__(self, table_cls, where=None):
-        return Queryset(table_cls, cursor=self._cursor, where=where)
\ No newline at end of file
+        return Queryset(table_cls, where=where, store=self)
+
+class WriteBehind:
+    '''
+    Buffer of the records added to a store in write-behind mode. A
+    background thread writes them with add_many() on a connection of
+    its own, once batch_size of them are waiting or every interval
+    seconds. add() blocks while max_pending records are waiting.
+
+    Buffered records have no id and aren't visible to queries until
+    written. flush() returns once all the records buffered before the
+    call are committed. close(), leaving the with block and the
+    interpreter exit write the remaining ones and end the mode. Records
+    still buffered when the process is killed are lost. Records that
+    can't be written are kept with their error in errors, flush() and
+    close() raise WriteBehindError for the ones found since their last
+    call.
+    '''
+    def __init__(self, store, batch_size=1000, interval=1.0, max_pending=100000):
+        if store.db == ":memory:" or store.db.startswith("file:"):
+            raise ValueError("write-behind needs the path of a database file")
+        self._store = store
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        # the flushing thread's own store, reporting to the same listeners
+        self._writer = Store("{}://{}".format(store.engine, store.db))
+        self._writer._listeners = store._listeners
+        # records waiting, by id(), a record added twice is written once
+        self._pending = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._added = self._written = self._flush_to = 0
+        self._closing = False
+        self.errors = []
+        self._reported = 0
+        self._thread = threading.Thread(
+            target=self._run, name="monkey-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, tab_inst):
+        with self._cond:
+            if self._closing:
+                raise ValueError("write-behind buffer is closed")
+            if id(tab_inst) in self._pending:
+                return
+            while len(self._pending) >= self.max_pending:
+                self._cond.wait()
+            self._pending[id(tab_inst)] = tab_inst
+            self._added += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.interval
+                while (len(self._pending) < self.batch_size and not self._closing
+                        and self._flush_to <= self._written):
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                batch = list(self._pending.values())
+                self._pending.clear()
+                # wakes the producers waiting for room
+                self._cond.notify_all()
+                if not batch and self._closing:
+                    return
+            if batch:
+                self._write(batch)
+            with self._cond:
+                self._written += len(batch)
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        try:
+            self._writer._add_many(batch, self.batch_size)
+            written = batch
+        except Exception:
+            # the batch was rolled back along with the state of its
+            # records, it is written record by record to find the
+            # failing ones
+            written = []
+            for tab_inst in batch:
+                try:
+                    self._writer.add(tab_inst)
+                    written.append(tab_inst)
+                except Exception as e:
+                    with self._cond:
+                        self.errors.append((tab_inst, e))
+        for tab_inst in written:
+            self._store._saved(tab_inst)
+
+    def _check_errors(self):
+        with self._cond:
+            errors = self.errors[self._reported:]
+            self._reported = len(self.errors)
+        if errors:
+            raise WriteBehindError(errors)
+
+    def flush(self):
+        with self._cond:
+            target = self._flush_to = self._added
+            self._cond.notify_all()
+            while self._written < target and self._thread.is_alive():
+                self._cond.wait()
+        self._check_errors()
+
+    def close(self):
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        atexit.unregister(self.close)
+        self._writer.close()
+        if self._store._buffer is self:
+            self._store._buffer = None
+        self._check_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ConnectionPool:
+    '''
+    At most size connections made by connect(), acquire() waits for
+    timeout seconds (forever when None) for one of them to be free
+    '''
+    def __init__(self, connect, size=5, timeout=None):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        # the connection released last is handed out first, its
+        # prepared statements are the most likely to be reused
+        self._idle = queue.LifoQueue()
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(
+                "No free connection after {} seconds".format(self.timeout))
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        self._idle.put(conn)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class _Checkout:
+    # connection held by a thread of a pooled store and its state,
+    # given back to the pool when released or when the thread ends
+    def __init__(self, pool):
+        self._pool = pool
+        self.conn = None
+        self.conn = pool.acquire()
+        self.cursor = self.conn.cursor()
+        self.tx_depth = 0
+        self.work = None
+        self.undo = None
+        self.written = None
+
+    def release(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        self.cursor.close()
+        if conn.in_transaction:
+            conn.execute("rollback")
+        self._pool.release(conn)
+
+    __del__ = release
+
+class PooledStore(Store):
+    '''
+    Store shared between threads. Each thread runs its statements on a
+    connection of a pool of pool_size, held from its first statement
+    until it calls release() or ends. Threads wait for timeout seconds
+    at most for a free connection. An in-memory database has a single
+    connection, the threads take turns holding it.
+    '''
+    # writers take the write lock up front: deferred transactions that
+    # read first deadlock on the lock upgrade instead of waiting for it
+    _begin_sql = "begin immediate"
+
+    def __init__(self, db_string, pool_size=5, timeout=None, **kwargs):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        super(PooledStore, self).__init__(db_string, **kwargs)
+
+    def _open(self):
+        # connections to ":memory:" would each get their own database,
+        # and shared-cache ones fail on table locks instead of waiting
+        if self.db == ":memory:":
+            self.pool_size = 1
+        self._pool = ConnectionPool(
+            lambda: self._connect(self.db), self.pool_size, self.timeout)
+        self._local = threading.local()
+
+    def _checkout(self):
+        checkout = getattr(self._local, "checkout", None)
+        if checkout is None or checkout.conn is None:
+            checkout = self._local.checkout = _Checkout(self._pool)
+        return checkout
+
+    @property
+    def _conn(self):
+        return self._checkout().conn
+
+    @property
+    def _cursor(self):
+        return self._checkout().cursor
+
+    @property
+    def _tx_depth(self):
+        return self._checkout().tx_depth
+
+    @_tx_depth.setter
+    def _tx_depth(self, depth):
+        self._checkout().tx_depth = depth
+
+    @property
+    def _work(self):
+        return self._checkout().work
+
+    @_work.setter
+    def _work(self, work):
+        self._checkout().work = work
+
+    @property
+    def _undo(self):
+        return self._checkout().undo
+
+    @_undo.setter
+    def _undo(self, undo):
+        self._checkout().undo = undo
+
+    @property
+    def _written(self):
+        return self._checkout().written
+
+    @_written.setter
+    def _written(self, written):
+        self._checkout().written = written
+
+    # holds a connection for the block, released at its end unless the
+    # thread already held one
+    @contextlib.contextmanager
+    def connection(self):
+        checkout = getattr(self._local, "checkout", None)
+        if checkout is not None and checkout.conn is not None:
+            yield checkout.conn
+            return
+        try:
+            yield self._checkout().conn
+        finally:
+            self.release()
+
+    # gives the connection of the calling thread back to the pool
+    def release(self):
+        checkout = getattr(self._local, "checkout", None)
+        if checkout is not None:
+            self._local.checkout = None
+            checkout.release()
+
+    def close(self):
+        self.release()
+        self._pool.close()
+
+class WalStore(PooledStore):
+    '''
+    Store over a database file in WAL mode: reads run on a pool of
+    pool_size read-only connections, writes are queued to a single
+    writer thread, which commits up to max_batch of them at once.
+
+    add(), add_many(), delete() and delete_many() return a Future
+    resolved when the write is committed, to the record for add().
+    Other writes (create_table, raw statements, Queryset.update and
+    delete, units of work) wait for their commit and return as usual.
+    '''
+    # transactions of the readers are read-only, the writer is alone
+    _begin_sql = "begin"
+
+    def __init__(self, db_string, pool_size=5, timeout=None, max_batch=1000, **kwargs):
+        self.max_batch = max_batch
+        super(WalStore, self).__init__(db_string, pool_size, timeout, **kwargs)
+
+    def _open(self):
+        if self.db == ":memory:" or self.db.startswith("file:"):
+            raise ValueError("WalStore needs the path of a database file")
+        writer_conn = self._connect(self.db)
+        writer_conn.execute("pragma journal_mode = wal")
+        ro_uri = pathlib.Path(self.db).absolute().as_uri() + "?mode=ro"
+        self._pool = ConnectionPool(
+            lambda: self._connect(ro_uri, True), self.pool_size, self.timeout)
+        self._write_pool = ConnectionPool(lambda: writer_conn, 1)
+        self._local = threading.local()
+        self._jobs = queue.Queue()
+        self._writer = threading.Thread(
+            target=self._write_loop, name="monkey-writer", daemon=True)
+        self._writer.start()
+
+    def _submit(self, kind, args):
+        future = Future()
+        self._jobs.put((kind, args, future))
+        return future
+
+    # calls fn on the writer thread and waits for its commit
+    def _call(self, fn, *args):
+        if threading.current_thread() is self._writer:
+            return fn(*args)
+        self._check_writable()
+        return self._submit("call", (fn, args)).result()
+
+    # transaction() of other threads runs on their read-only connection,
+    # writes are committed apart from it by the writer thread
+    def _check_writable(self):
+        if self._tx_depth:
+            raise ReadOnlyTransaction(
+                "WalStore transactions are read-only, write with unit_of_work()")
+
+    def _write_loop(self):
+        self._local.checkout = _Checkout(self._write_pool)
+        running = True
+        while running:
+            jobs = []
+            job = self._jobs.get()
+            while job is not None:
+                if job[2].set_running_or_notify_cancel():
+                    jobs.append(job)
+                if len(jobs) >= self.max_batch:
+                    break
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+            running = job is not None
+            if jobs:
+                self._commit(jobs)
+        self.release()
+
+    # writes the jobs in one transaction, each in a savepoint, so that
+    # a failing one is rolled back alone; adds in a row are coalesced
+    # into one add_many(), written one by one again if it fails
+    def _commit(self, jobs):
+        done = []
+        try:
+            with self.transaction():
+                for (kind, _), group in itertools.groupby(jobs, key=self._batch_key):
+                    group = list(group)
+                    if kind == "add" and len(group) > 1:
+                        try:
+                            with self.transaction():
+                                self._add_many(
+                                    [args[0] for _, args, _ in group],
+                                    conflict_col=self._conflict_col(group[0][1][1]))
+                        except Exception:
+                            pass
+                        else:
+                            done.extend((future, args[0]) for _, args, future in group)
+                            continue
+                    for job in group:
+                        self._run_job(job, done)
+        except Exception as e:
+            for future, _ in done:
+                future.set_exception(e)
+            return
+        for future, res in done:
+            future.set_result(res)
+
+    @staticmethod
+    def _batch_key(job):
+        kind, args, future = job
+        if kind == "add":
+            return kind, id(args[1])
+        return kind, id(future)
+
+    def _run_job(self, job, done):
+        kind, args, future = job
+        try:
+            with self.transaction():
+                if kind == "add":
+                    Store.add(self, *args)
+                    res = args[0]
+                else:
+                    fn, fn_args = args
+                    res = fn(*fn_args)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            done.append((future, res))
+
+    def _queued(self):
+        # writes of the writer thread and of units of work run directly
+        if threading.current_thread() is self._writer or self._work is not None:
+            return False
+        self._check_writable()
+        return True
+
+    def add(self, tab_inst, upsert=None):
+        if not self._queued():
+            return Store.add(self, tab_inst, upsert)
+        return self._submit("add", (tab_inst, upsert))
+
+    __add__ = __radd__ = add
+
+    def add_many(self, tab_insts, batch_size=1000, upsert=None):
+        if not self._queued():
+            return Store.add_many(self, tab_insts, batch_size, upsert)
+        return self._submit("call", (
+            Store.add_many, (self, list(tab_insts), batch_size, upsert)))
+
+    def delete(self, tab_inst):
+        if not self._queued():
+            return Store.delete(self, tab_inst)
+        return self._submit("call", (Store.delete, (self, tab_inst)))
+
+    __sub__ = delete
+
+    def delete_many(self, tab_insts):
+        if not self._queued():
+            return Store.delete_many(self, tab_insts)
+        return self._submit("call", (
+            Store.delete_many, (self, list(tab_insts))))
+
+    def _flush_work(self, work):
+        self._call(Store._flush_work, self, work)
+
+    def _run_write(self, sql, params=()):
+        return self._call(Store._run_write, self, sql, params)
+
+    def create_table(self, table_cls):
+        self._call(Store.create_table, self, table_cls)
+
+    __lshift__ = create_table
+
+    def raw(self, sql, params=(), table_cls=None):
+        if self._read_sql_re.match(sql):
+            return Store.raw(self, sql, params, table_cls)
+        return self._call(Store.raw, self, sql, params, table_cls)
+
+    __truediv__ = raw
+
+    # waits for the queued writes to be written
+    def close(self):
+        self._jobs.put(None)
+        self._writer.join()
+        super(WalStore, self).close()
+        self._write_pool.close()
+
+class AsyncQueryset:
+    '''
+    Queryset of an AsyncStore, built like a Queryset, its reads and
+    writes are awaited and async iteration streams the rows in chunks
+    '''
+    def __init__(self, store, qs):
+        self._store = store
+        self._qs = qs
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return AsyncQueryset(self._store, self._qs[k])
+        return self._store._read(self._qs.__getitem__, k)
+
+    def all(self):
+        return self._store._read(self._qs.all)
+
+    def count(self):
+        return self._store._read(self._qs.count)
+
+    def exists(self):
+        return self._store._read(self._qs.exists)
+
+    def aggregate(self, *aggs):
+        return self._store._read(self._qs.aggregate, *aggs)
+
+    def explain(self):
+        return self._store._read(self._qs.explain)
+
+    def update(self, **kwargs):
+        return self._store._write(functools.partial(self._qs.update, **kwargs))
+
+    def delete(self):
+        return self._store._write(self._qs.delete)
+
+    # rows are fetched and built chunk_size at a time on the workers, on
+    # a connection held by the iteration, so that no worker waits for
+    # the consumer of the rows
+    # the pool has a connection for each of the streams iterations let
+    # in at once, others wait for one of them to end without holding a
+    # worker
+    async def iterator(self, chunk_size=None):
+        chunk_size = chunk_size or self._qs.chunk_size
+        store = self._store
+        async with store._streams:
+            conn = None
+            qs = self._qs
+            if store._pool is not None:
+                conn = await store._run(None, store._pool.acquire)
+                qs = copy.copy(qs)
+                qs.set_cursor(conn.cursor())
+            recs = qs.iterator(chunk_size)
+            next_chunk = lambda: list(itertools.islice(recs, chunk_size))
+            try:
+                while True:
+                    chunk = await store._run(store._readers, next_chunk)
+                    if not chunk:
+                        break
+                    for rec in chunk:
+                        yield rec
+            finally:
+                recs.close()
+                if conn is not None:
+                    qs._cursor.close()
+                    store._pool.release(conn)
+
+    def __aiter__(self):
+        return self.iterator()
+
+def _async_builder(name):
+    def builder(self, *args, **kwargs):
+        getattr(self._qs, name)(*args, **kwargs)
+        return self
+    builder.__name__ = name
+    return builder
+
+for _name in ("order_by", "only", "values", "values_list", "limit", "offset",
+        "after", "group_by", "select_related", "prefetch_related"):
+    setattr(AsyncQueryset, _name, _async_builder(_name))
+
+class AsyncStore:
+    '''
+    asyncio front of a store, its statements run on threads: reads on
+    up to workers at once, each thread keeping its own connection, and
+    writes on a single one. Database files are opened by a PooledStore
+    (store attribute) and switched to WAL mode, so that paused iterations
+    don't block writes, in-memory databases by a Store whose statements
+    all run on one thread.
+    '''
+    def __init__(self, db_string, workers=4, streams=4, **kwargs):
+        # iterations in progress at once
+        self._streams = asyncio.Semaphore(streams)
+        if db_string.endswith("://:memory:"):
+            self.store = Store(db_string, **kwargs)
+            self._pool = None
+            self._readers = self._writer = ThreadPoolExecutor(
+                1, thread_name_prefix="monkey")
+            return
+        # a connection per reader, one for the writer and one per
+        # iteration in progress
+        self.store = PooledStore(
+            db_string, pool_size=workers + 1 + streams, **kwargs)
+        with self.store.connection() as conn:
+            conn.execute("pragma journal_mode = wal")
+        self._pool = self.store._pool
+        self._readers = ThreadPoolExecutor(
+            workers, thread_name_prefix="monkey-read")
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="monkey-write")
+
+    def _run(self, executor, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+    def _read(self, fn, *args):
+        return self._run(self._readers, fn, *args)
+
+    def _write(self, fn, *args):
+        return self._run(self._writer, fn, *args)
+
+    # runs fn(store) on the writer thread, e.g. to write in a transaction
+    def run(self, fn, *args):
+        return self._write(fn, self.store, *args)
+
+    def create_table(self, table_cls):
+        return self._write(self.store.create_table, table_cls)
+
+    def add(self, tab_inst, upsert=None):
+        return self._write(self.store.add, tab_inst, upsert)
+
+    def add_many(self, tab_insts, batch_size=1000, upsert=None):
+        return self._write(self.store.add_many, list(tab_insts), batch_size, upsert)
+
+    def delete(self, tab_inst):
+        return self._write(self.store.delete, tab_inst)
+
+    def delete_many(self, tab_insts):
+        return self._write(self.store.delete_many, list(tab_insts))
+
+    def raw(self, sql, params=(), table_cls=None):
+        if Store._read_sql_re.match(sql):
+            return self._read(self.store.raw, sql, params, table_cls)
+        return self._write(self.store.raw, sql, params, table_cls)
+
+    def __call__(self, table_cls, where=None):
+        return AsyncQueryset(self, self.store(table_cls, where))
+
+    def _shutdown(self):
+        self._readers.shutdown()
+        self._writer.shutdown()
+        self.store.close()
+
+    async def close(self):
+        await self._run(None, self._shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
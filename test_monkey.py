@@ -1,4 +1,10 @@
+import os
+import operator
+import asyncio
 import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 from monkey import *
 from datetime import datetime
@@ -88,6 +94,33 @@ class OrmSqliteTest(unittest.TestCase):
         self.assertIn(("table1_table2",), tables)
         self.assertIn(("my_table",), tables)
 
+    def test_create_table_indexes(self):
+        class Tab(Table):
+            id = Auto(primary_key=True)
+            name = Text(index=True)
+            kind = Integer()
+            price = Float()
+            __indexes__ = [
+                Index(kind, name, unique=True),
+                Index(price * 2, where=(kind > 0) & (name != "it's")),
+                Index("lower(name)", name="tab_lower_name")]
+
+        self.store.create_table(Tab)
+        self.store.create_table(Tab)
+        indexes = self.cur.execute(
+            "select name, sql from sqlite_master where type = 'index' "
+            "order by name").fetchall()
+        self.assertEqual(indexes, [
+            ("tab_idx2", "CREATE INDEX tab_idx2 on tab ((price * 2)) "
+                "where (kind > 0) and (name != 'it''s')"),
+            ("tab_kind_name_idx", "CREATE UNIQUE INDEX tab_kind_name_idx on tab (kind, name)"),
+            ("tab_lower_name", "CREATE INDEX tab_lower_name on tab (lower(name))"),
+            ("tab_name_idx", "CREATE INDEX tab_name_idx on tab (name)"),
+            ])
+        plan = self.cur.execute(
+            "explain query plan select * from tab where name = 'x'").fetchall()
+        self.assertIn("tab_name_idx", plan[0][-1])
+
     def test_create_table_lshift(self):
         class Tab(Table):
             id = Auto(primary_key=True)
@@ -199,6 +232,42 @@ class OrmSqliteTest(unittest.TestCase):
 
         t = Tab(name="name 1")
         self.assertEqual(t.columns["name"], "name 1")
+        with self.assertRaises(TypeError):
+            t.columns["name"] = "name 2"
+
+    def test_record_slots(self):
+        class Tab(Table):
+            id = Auto(primary_key=True)
+            name = Text(default=1)
+
+        t = Tab(name="name 1")
+        self.assertFalse(hasattr(t, "__dict__"))
+        self.assertEqual(Tab.__slots__, ("_id", "_name"))
+        self.assertEqual(t._name, "name 1")
+        self.assertEqual(Tab()._name, 1)
+        t.name = "name 2"
+        self.assertEqual(t._name, "name 2")
+        self.assertEqual(t.columns, {"id": None, "name": "name 2"})
+        self.assertTrue(isinstance(Tab.name, Text))
+
+    def test_record_fromtuple(self):
+        rec = Table2.fromtuple((1, "rec1"))
+        self.assertEqual((rec.id, rec.title), (1, "rec1"))
+        self.assertFalse(rec.updated)
+        self.assertTrue(rec._persisted)
+        with self.assertRaises(ValueError):
+            Table2.fromtuple((1,))
+
+    def test_store_raw_row_factory(self):
+        self.store.create_table(Table2)
+        self.store.add(Table2(title="rec1"))
+        self.store.add(Table2(title="rec2"))
+        recs = self.store.raw(
+            "select * from table2 where id > ?", (1,), table_cls=Table2)
+        self.assertEqual(len(recs), 1)
+        self.assertTrue(isinstance(recs[0], Table2))
+        self.assertEqual(recs[0].title, "rec2")
+        self.assertEqual(self.store.raw("select id from table2"), [(1,), (2,)])
 
     def test_two_records_have_different_attrs(self):
         class Tab(Table):
@@ -330,6 +399,139 @@ class OrmSqliteTest(unittest.TestCase):
         self.assertEqual(second.id, 3)
         self.assertEqual(second.title, "rec2")
 
+    def test_store_add_many(self):
+        self.store.create_table(Table2)
+        self.store.create_table(Table3)
+        self.store.add(Table2(title="rec0"))
+        recs = [Table2(title="rec{}".format(i)) for i in range(1, 6)] + [Table3()]
+        count = self.store.add_many(iter(recs), batch_size=2)
+        self.assertEqual(count, 6)
+        self.assertEqual([r.id for r in recs], [2, 3, 4, 5, 6, 1])
+        self.assertEqual(
+            self.cur.execute("select * from table2 where id = 4").fetchall(),
+            [(4, "rec3")])
+        self.assertEqual(len(self.store(Table3).all()), 1)
+
+    def test_store_add_many_with_ids(self):
+        self.store.create_table(Table2)
+        rec = Table2(title="rec1")
+        self.store.add(rec)
+        rec.title = "new rec1"
+        self.store.add_many([rec, Table2(title="rec2")])
+        self.assertEqual(
+            self.cur.execute("select * from table2").fetchall(),
+            [(1, "new rec1"), (2, "rec2")])
+
+    def test_store_transaction_rollback(self):
+        self.store.create_table(Table2)
+        with self.assertRaises(ValueError):
+            with self.store.transaction():
+                self.store.add(Table2(title="rec1"))
+                raise ValueError
+        self.assertEqual(self.store.raw("select * from table2"), [])
+
+    def test_store_transaction_rollback_records(self):
+        self.store.create_table(Table2)
+        rec = Table2(title="rec1")
+        with self.assertRaises(ValueError):
+            with self.store.transaction():
+                self.store.add(rec)
+                raise ValueError
+        self.assertEqual((rec.id, rec.updated), (None, False))
+        self.store.add(rec)
+        self.assertEqual(self.store.raw("select * from table2"), [(1, "rec1")])
+        recs = [Table2(title="rec{}".format(i)) for i in range(2, 5)] + [
+            Table5(text_field="x")]
+        with self.assertRaises(sqlite3.OperationalError):
+            self.store.add_many(recs, batch_size=2)
+        self.assertEqual([r.id for r in recs], [None] * 4)
+        self.store.create_table(Table5)
+        self.store.add_many(recs, batch_size=2)
+        self.assertEqual(
+            self.store.raw("select * from table2"),
+            [(1, "rec1"), (2, "rec2"), (3, "rec3"), (4, "rec4")])
+
+    def test_store_transaction_drops_records(self):
+        self.store.create_table(Table2)
+        kept = Table2(title="kept")
+        with self.assertRaises(ValueError):
+            with self.store.transaction():
+                self.store.add_many(
+                    Table2(title="rec{}".format(i)) for i in range(100))
+                self.store.add(kept)
+                self.assertEqual(len(self.store._undo), 1)
+                raise ValueError
+        self.assertEqual((kept.id, kept.updated), (None, False))
+
+    def test_store_transaction_failed_commit(self):
+        class Child(Table):
+            id = Auto(primary_key=True)
+            parent_id = Integer()
+
+        self.store.raw("create table parent (id integer primary key)")
+        self.store.raw(
+            "create table child (id integer primary key, parent_id integer "
+            "references parent(id) deferrable initially deferred)")
+        rec = Child(parent_id=1)
+        with self.assertRaises(sqlite3.IntegrityError):
+            with self.store.transaction():
+                self.store.add(rec)
+        self.assertFalse(self.store._conn.in_transaction)
+        self.assertEqual((rec.id, rec.updated), (None, False))
+        self.store.raw("insert into parent values (1)")
+        self.store.add_many([rec])
+        self.assertEqual(self.store.raw("select * from child"), [(1, 1)])
+
+    def test_store_transaction_savepoint(self):
+        self.store.create_table(Table2)
+        with self.store.transaction():
+            self.store.add(Table2(title="rec1"))
+            try:
+                with self.store.transaction():
+                    self.store.add(Table2(title="rec2"))
+                    raise ValueError
+            except ValueError:
+                pass
+            self.store.add(Table2(title="rec3"))
+        self.assertEqual(
+            self.store.raw("select title from table2"),
+            [("rec1",), ("rec3",)])
+
+    def test_store_transaction_commit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, "test.db")
+            store = Store("sqlite://" + db)
+            store.create_table(Table2)
+            with store.transaction():
+                store.add(Table2(title="rec1"))
+            conn = sqlite3.connect(db)
+            self.assertEqual(
+                conn.execute("select * from table2").fetchall(),
+                [(1, "rec1")])
+            conn.close()
+
+    def test_store_unit_of_work(self):
+        self.store.create_table(Table2)
+        rec1 = Table2(title="rec1")
+        self.store.add(rec1)
+        with self.store.unit_of_work():
+            rec2 = Table2(title="rec2")
+            self.store + rec2
+            self.store + rec2
+            self.store - rec1
+            self.assertEqual(self.store.raw("select id from table2"), [(1,)])
+        self.assertEqual(rec2.id, 2)
+        self.assertEqual(
+            self.store.raw("select * from table2"), [(2, "rec2")])
+
+    def test_store_unit_of_work_error(self):
+        self.store.create_table(Table2)
+        with self.assertRaises(ValueError):
+            with self.store.unit_of_work():
+                self.store.add(Table2(title="rec1"))
+                raise ValueError
+        self.assertEqual(self.store.raw("select * from table2"), [])
+
     def test_record_updated(self):
         class Tab(Table):
             id = Auto(primary_key=True)
@@ -340,6 +542,104 @@ class OrmSqliteTest(unittest.TestCase):
         t.name = "name 2"
         self.assertTrue(t.updated)
 
+    def test_record_loaded_not_updated(self):
+        self.store.create_table(Table2)
+        self.store.add(Table2(title="rec1"))
+        rec = self.store(Table2).all()[0]
+        self.assertFalse(rec.updated)
+        changes = self.store._conn.total_changes
+        self.store.add(rec)
+        self.assertEqual(self.store._conn.total_changes, changes)
+        self.assertEqual(len(self.store(Table2).all()), 1)
+
+    def test_store_update_changed_columns(self):
+        self.store.create_table(Table5)
+        self.store.add(Table5(text_field="text", int_field=1))
+        rec = self.store(Table5).all()[0]
+        self.store.raw("update my_table set int_field = 2")
+        rec.text_field = "new text"
+        self.store.add(rec)
+        self.assertFalse(rec.updated)
+        self.assertEqual(
+            self.store.raw("select id, text_field, int_field from my_table"),
+            [(1, "new text", 2)])
+
+    def test_store_add_many_updates(self):
+        self.store.create_table(Table2)
+        self.store.add_many(Table2(title="rec{}".format(i)) for i in range(3))
+        recs = self.store(Table2).all()
+        recs[1].title = "new rec1"
+        self.store.add_many(recs + [Table2(title="rec3")])
+        self.assertEqual(
+            self.store.raw("select * from table2"),
+            [(1, "rec0"), (2, "new rec1"), (3, "rec2"), (4, "rec3")])
+
+    def test_store_add_explicit_id_keeps_rowid(self):
+        self.store.create_table(Table2)
+        self.store.create_table(Table1)
+        self.store.add(Table2(title="rec1"))
+        self.store.raw("insert into table1_table2 values (null, 1)")
+        self.store.add(Table2(id=1, title="new rec1"))
+        self.assertEqual(self.store.raw("select * from table2"), [(1, "new rec1")])
+        self.assertEqual(
+            self.store.raw("select * from table1_table2"), [(None, 1)])
+
+    def test_store_upsert_unique(self):
+        class Tab(Table):
+            id = Auto(primary_key=True)
+            email = Text(unique=True)
+            name = Text()
+
+        self.store.create_table(Tab)
+        self.store.add(Tab(email="a@x", name="a"))
+        self.store.add(Tab(email="b@x", name="b"))
+        rec = Tab(email="b@x", name="new b")
+        self.store.add(rec, upsert=Tab.email)
+        self.assertEqual(rec.id, 2)
+        self.assertEqual(
+            self.store.raw("select * from tab"),
+            [(1, "a@x", "a"), (2, "b@x", "new b")])
+        # an explicit id gives way to the id of the conflicting row
+        rec = Tab(id=5, email="a@x", name="z")
+        self.store.add(rec, upsert=Tab.email)
+        self.assertEqual(rec.id, 1)
+        rec.name = "zz"
+        self.store.add(rec)
+        recs = [Tab(id=7, email="b@x", name="y")]
+        self.store.add_many(recs, upsert=Tab.email)
+        self.assertEqual(recs[0].id, 2)
+        self.assertEqual(
+            self.store.raw("select * from tab"),
+            [(1, "a@x", "zz"), (2, "b@x", "y")])
+
+    def test_store_upsert_many(self):
+        class Tab(Table):
+            id = Auto(primary_key=True)
+            email = Text(unique=True)
+            name = Text()
+
+        self.store.create_table(Tab)
+        self.store.add(Tab(email="a@x", name="a"))
+        recs = [Tab(email="b@x", name="b"), Tab(email="a@x", name="new a")]
+        self.store.add_many(recs, upsert=Tab.email)
+        self.assertEqual([r.id for r in recs], [2, 1])
+        self.assertEqual(
+            self.store.raw("select * from tab"),
+            [(1, "a@x", "new a"), (2, "b@x", "b")])
+        with self.store.unit_of_work():
+            self.store.add(Tab(email="b@x", name="new b"), upsert=Tab.email)
+        self.assertEqual(
+            self.store.raw("select name from tab where id = 2"), [("new b",)])
+
+    def test_store_upsert_not_unique(self):
+        class Tab(Table):
+            id = Auto(primary_key=True)
+            name = Text()
+
+        self.store.create_table(Tab)
+        with self.assertRaises(NotUniqueField):
+            self.store.add(Tab(name="a"), upsert=Tab.name)
+
     def test_record_id_set_correctly(self):
         class Tab(Table):
             id = Auto(primary_key=True)
@@ -391,6 +691,39 @@ class OrmSqliteTest(unittest.TestCase):
         recs = self.store(Table2)
         self.assertTrue(isinstance(recs, Queryset))
 
+    def test_queryset_iterate(self):
+        self.store.create_table(Table2)
+        for i in range(5):
+            self.store.add(Table2(title="rec{}".format(i)))
+        recs = [r.title for r in self.store(Table2, Table2.id > 1)]
+        self.assertEqual(recs, ["rec1", "rec2", "rec3", "rec4"])
+
+    def test_queryset_iterator_chunk_size(self):
+        self.store.create_table(Table2)
+        for i in range(5):
+            self.store.add(Table2(title="rec{}".format(i)))
+        recs = self.store(Table2).iterator(chunk_size=2)
+        self.assertEqual([r.id for r in recs], [1, 2, 3, 4, 5])
+
+    def test_queryset_iterate_and_add(self):
+        self.store.create_table(Table2)
+        self.store.create_table(Table5)
+        self.store.add(Table2(title="rec1"))
+        self.store.add(Table2(title="rec2"))
+        seen = []
+        for rec in self.store(Table2).iterator(chunk_size=1):
+            seen.append(rec.id)
+            self.store.add(Table5(text_field="x"))
+        self.assertEqual(seen, [1, 2])
+
+    def test_queryset_all_twice(self):
+        self.store.create_table(Table2)
+        self.store.add(Table2(title="rec1"))
+        self.store.add(Table2(title="rec2"))
+        recs = self.store(Table2, Table2.title == "rec2")
+        self.assertEqual(len(recs.all()), 1)
+        self.assertEqual(len(recs.all()), 1)
+
     @unittest.skip
     def test_foreign_key_set(self):
         class NewTab(Table):
@@ -837,4 +1170,813 @@ class FieldSqliteTest(unittest.TestCase):
 
 class TestExpressions(unittest.TestCase):
     def test_expr_left_right(self):
-        pass
\ No newline at end of file
+        pass
+
+    def test_expr_compile_params(self):
+        sql, params = (Table2.title == "it's").compile()
+        self.assertEqual(sql, "table2.title = ?")
+        self.assertEqual(params, ("it's",))
+
+    def test_expr_compile_and_or(self):
+        expr = (Table2.id > 1) & (Table2.id < 5) | (Table2.title == "x")
+        sql, params = expr.compile()
+        self.assertEqual(sql, "((table2.id > ?) and (table2.id < ?)) or (table2.title = ?)")
+        self.assertEqual(params, (1, 5, "x"))
+
+    def test_expr_compile_in_like(self):
+        sql, params = Table2.id.is_in([1, 2, 3]).compile()
+        self.assertEqual(sql, "table2.id in (?, ?, ?)")
+        self.assertEqual(params, (1, 2, 3))
+        sql, params = Table2.title.like("ab").compile()
+        self.assertEqual(sql, "table2.title like ?")
+        self.assertEqual(params, ("%ab%",))
+
+    def test_expr_compile_arithmetic(self):
+        sql, params = (Table2.id == (Table2.id + 1) * 2).compile()
+        self.assertEqual(sql, "table2.id = ((table2.id + ?) * ?)")
+        self.assertEqual(params, (1, 2))
+        self.assertEqual((10 - Table2.id).compile(), ("(? - table2.id)", (10,)))
+
+    def test_expr_same_shape(self):
+        self.assertEqual(
+            (Table2.id == 1).shape([]),
+            (Table2.id == 2).shape([]))
+        self.assertNotEqual(
+            (Table2.id == 1).shape([]),
+            (Table2.id != 1).shape([]))
+
+    def test_expr_compile_null(self):
+        self.assertEqual(
+            (Table2.title == None).compile(), ("table2.title is null", ()))
+        self.assertEqual(
+            (Table2.title != None).compile(),
+            ("table2.title is not null", ()))
+        self.assertNotEqual(
+            (Table2.title == None).shape([]),
+            (Table2.title == "x").shape([]))
+
+
+class QuerysetTest(unittest.TestCase):
+    def setUp(self):
+        self.store = store = Store("sqlite://:memory:")
+        store.create_table(Table2)
+        store.create_table(Table5)
+
+    def test_store_statement_cache(self):
+        store = self.store
+        store.add(Table2(title="rec1"))
+        store.add(Table2(title="it's"))
+        self.assertEqual(store(Table2, Table2.title == "it's").all()[0].id, 2)
+        cached = len(store._statements)
+        self.assertEqual(store(Table2, Table2.title == "rec1").all()[0].id, 1)
+        self.assertEqual(len(store._statements), cached)
+
+    def test_queryset_null(self):
+        store = self.store
+        store.add(Table2(title="rec1"))
+        store.add(Table2())
+        self.assertEqual(store(Table2, Table2.title == "rec1").count(), 1)
+        self.assertEqual(store(Table2, Table2.title == None).count(), 1)
+        self.assertEqual(store(Table2, Table2.title != None).count(), 1)
+
+    def test_queryset_only(self):
+        store = self.store
+        store.add(Table5(text_field="text", int_field=1, blob_field=b"x"))
+        rec = store(Table5).only(Table5.int_field).all()[0]
+        self.assertEqual((rec.id, rec.int_field, rec.blob_field), (1, 1, None))
+        rec.int_field = 2
+        store.add(rec)
+        self.assertEqual(
+            store.raw("select text_field, int_field, blob_field from my_table"),
+            [("text", 2, b"x")])
+
+    def test_queryset_values(self):
+        store = self.store
+        store.add(Table2(title="rec1"))
+        store.add(Table2(title="rec2"))
+        self.assertEqual(
+            store(Table2, Table2.id == 2).values().all(),
+            [{"id": 2, "title": "rec2"}])
+        self.assertEqual(
+            store(Table2).values(Table2.title).all(),
+            [{"title": "rec1"}, {"title": "rec2"}])
+
+    def test_queryset_values_list(self):
+        store = self.store
+        store.add(Table2(title="rec1"))
+        store.add(Table2(title="rec2"))
+        self.assertEqual(
+            store(Table2).values_list(Table2.title, Table2.id).all(),
+            [("rec1", 1), ("rec2", 2)])
+        self.assertEqual(
+            store(Table2).values_list(Table2.title, flat=True).all(),
+            ["rec1", "rec2"])
+        with self.assertRaises(TypeError):
+            store(Table2).values_list(flat=True)
+
+    def test_queryset_count_exists(self):
+        store = self.store
+        store.add_many(Table2(title="rec{}".format(i % 2)) for i in range(5))
+        self.assertEqual(store(Table2).count(), 5)
+        self.assertEqual(store(Table2, Table2.title == "rec1").count(), 2)
+        self.assertTrue(store(Table2, Table2.title == "rec1").exists())
+        self.assertFalse(store(Table2, Table2.title == "rec2").exists())
+
+    def test_queryset_aggregate(self):
+        store = self.store
+        store.add_many(
+            Table5(text_field="t{}".format(i % 2), int_field=i) for i in range(5))
+        self.assertEqual(
+            store(Table5).aggregate(Sum(Table5.int_field), Max(Table5.int_field)),
+            (10, 4))
+        self.assertEqual(
+            store(Table5, Table5.int_field > 0).aggregate(
+                Count(), Min(Table5.int_field), Avg(Table5.int_field)),
+            (4, 1, 2.5))
+
+    def test_queryset_group_by(self):
+        store = self.store
+        store.add_many(
+            Table5(text_field="t{}".format(i % 2), int_field=i) for i in range(5))
+        recs = store(Table5, Table5.int_field < 4).group_by(
+            Table5.text_field).order_by(Table5.text_field).aggregate(
+            Count(), Sum(Table5.int_field))
+        self.assertEqual(recs, [("t0", 2, 2), ("t1", 2, 4)])
+        # slices of a grouped queryset page through the groups
+        store.add_many(Table2(title=title) for title in "aaabbbccc")
+        qs = store(Table2).group_by(Table2.title).order_by(Table2.title)
+        self.assertEqual(qs[:2].aggregate(Count()), [("a", 3), ("b", 3)])
+        self.assertEqual(qs[1:].aggregate(Count()), [("b", 3), ("c", 3)])
+
+    def test_queryset_slice(self):
+        store = self.store
+        store.add_many(Table2(title="rec{}".format(i)) for i in range(10))
+        qs = store(Table2)
+        self.assertEqual([r.id for r in qs[2:5]], [3, 4, 5])
+        self.assertEqual([r.id for r in qs[8:]], [9, 10])
+        self.assertEqual([r.id for r in qs[2:8][1:3]], [4, 5])
+        self.assertEqual(qs[3].id, 4)
+        self.assertEqual(qs[2:5].count(), 3)
+        self.assertEqual(qs[2:5].aggregate(Sum(Table2.id)), (12,))
+        self.assertFalse(qs[10:].exists())
+        self.assertEqual(len(qs.all()), 10)
+        with self.assertRaises(IndexError):
+            qs[10]
+        with self.assertRaises(ValueError):
+            qs[-1:]
+
+    def test_queryset_after(self):
+        store = self.store
+        store.add_many(Table2(title="rec{}".format(i % 2)) for i in range(10))
+        page = store(Table2, Table2.title == "rec0").after(Table2.id, 3).limit(2).all()
+        self.assertEqual([r.id for r in page], [5, 7])
+        page = store(Table2).order_by(Desc(Table2.id)).after(Table2.id, 3).all()
+        self.assertEqual([r.id for r in page], [2, 1])
+        qs = store(Table2, Table2.title == "rec0").limit(2)
+        self.assertEqual([r.id for r in qs.after(Table2.id, 3).all()], [5, 7])
+        self.assertEqual([r.id for r in qs.after(Table2.id, 7).all()], [9])
+        self.assertEqual(qs._select_sql()[1], ("rec0", 7, 2))
+
+    def test_queryset_delete(self):
+        store = self.store
+        store.add_many(Table2(title="rec{}".format(i % 2)) for i in range(6))
+        self.assertEqual(store(Table2, Table2.title == "rec1").delete(), 3)
+        self.assertEqual(store(Table2)[1:].delete(), 2)
+        self.assertEqual(store.raw("select * from table2"), [(1, "rec0")])
+
+    def test_queryset_update(self):
+        store = self.store
+        store.add_many(Table5(text_field="t", int_field=i) for i in range(4))
+        count = store(Table5, Table5.int_field > 1).update(
+            text_field="x", int_field=Table5.int_field * 10 + 1)
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            store.raw("select text_field, int_field from my_table"),
+            [("t", 0), ("t", 1), ("x", 21), ("x", 31)])
+        self.assertEqual(store(Table5).order_by(Desc(Table5.id))[:1].update(
+            int_field=0), 1)
+        self.assertEqual(store(Table5).aggregate(Max(Table5.int_field)), (21,))
+        with self.assertRaises(UnknownTableColumn):
+            store(Table5).update(unknown=1)
+
+    def test_queryset_order_by(self):
+        store = self.store
+        store.add(Table2(title="rec1"))
+        store.add(Table2(title="rec2"))
+        recs = store(Table2).order_by(Desc(Table2.id)).all()
+        self.assertEqual([r.id for r in recs], [2, 1])
+        # orderings by expressions bind their values in place
+        store.add_many(Table5(text_field="t", int_field=i) for i in range(5))
+        qs = store(Table5, Table5.int_field > 0).order_by(Table5.int_field * -1)
+        self.assertEqual([r.int_field for r in qs.all()], [4, 3, 2, 1])
+        qs = store(Table5, Table5.int_field > 0).order_by(
+            Desc((Table5.int_field - 2) * (Table5.int_field - 2)))
+        self.assertEqual(qs[:2].values_list(Table5.int_field, flat=True).all(), [4, 1])
+        self.assertEqual(qs[:2].aggregate(Sum(Table5.int_field)), (5,))
+        self.assertEqual(qs[:2].count(), 2)
+        grouped = store(Table5).group_by(Table5.int_field).order_by(
+            Table5.int_field * -1)
+        self.assertEqual(grouped[:1].aggregate(Count()), [(4, 1)])
+        self.assertEqual(qs[:1].update(text_field="x"), 1)
+        self.assertEqual(qs[:1].delete(), 1)
+        self.assertEqual(
+            store.raw("select int_field, text_field from my_table"),
+            [(0, "t"), (1, "t"), (2, "t"), (3, "t")])
+
+    def test_queryset_select_related(self):
+        class Author(Table):
+            id = Auto(primary_key=True)
+            name = Text()
+
+        class Book(Table):
+            id = Auto(primary_key=True)
+            title = Text()
+            author = ForeignKey(Author)
+
+        store = self.store
+        store << Author
+        store << Book
+        store.add_many([Author(name="a1"), Author(name="a2")])
+        store.add_many([
+            Book(title="b1", author=2), Book(title="b2", author=1),
+            Book(title="b3")])
+        statements = []
+        store._conn.set_trace_callback(statements.append)
+        books = store(Book, Author.name != "a1").select_related(
+            Book.author).order_by(Book.id).all()
+        store._conn.set_trace_callback(None)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(len(books), 1)
+        self.assertEqual(books[0].author, 2)
+        self.assertEqual(books[0].related(Book.author).name, "a2")
+        books = store(Book).select_related(Book.author).all()
+        self.assertEqual(books[1].related(Book.author).id, 1)
+        self.assertIsNone(books[2].related(Book.author))
+        self.assertEqual(store(Book).select_related(Book.author).count(), 3)
+        with self.assertRaises(RelationNotLoaded):
+            store(Book).all()[0].related(Book.author)
+
+    def test_queryset_select_related_same_table(self):
+        class Person(Table):
+            id = Auto(primary_key=True)
+            name = Text()
+
+        class Message(Table):
+            id = Auto(primary_key=True)
+            sender = ForeignKey(Person)
+            recipient = ForeignKey(Person)
+
+        store = self.store
+        store << Person
+        store << Message
+        store.add_many([Person(name="p1"), Person(name="p2")])
+        store.add(Message(sender=1, recipient=2))
+        msgs = store(Message, Person.name == "p1").select_related(
+            Message.sender, Message.recipient).all()
+        self.assertEqual(
+            [msgs[0].related(Message.sender).name,
+                msgs[0].related(Message.recipient).name], ["p1", "p2"])
+        self.assertEqual(store(Message, Person.name == "p2").select_related(
+            Message.sender, Message.recipient).count(), 0)
+
+    def test_queryset_prefetch_related(self):
+        store = self.store
+        store.create_table(Table3)
+        store.create_table(Table1)
+        store.add_many(Table2(title="rec{}".format(i)) for i in range(3))
+        store.add_many(Table1() for i in range(3))
+        store.raw("insert into table1_table2 values (1, 1), (1, 3), (3, 2)")
+        statements = []
+        store._conn.set_trace_callback(statements.append)
+        recs = store(Table1).prefetch_related(Table1.m2m_field).iterator(
+            chunk_size=2)
+        recs = list(recs)
+        store._conn.set_trace_callback(None)
+        self.assertEqual(len(statements), 3)
+        self.assertEqual([r.title for r in recs[0].m2m_field], ["rec0", "rec2"])
+        self.assertEqual(recs[1].m2m_field, [])
+        self.assertEqual([r.id for r in recs[2].m2m_field], [2])
+        qs = store(Table1).prefetch_related(Table1.m2m_field)
+        qs.prefetch_chunk_size = 1
+        recs = qs.all()
+        self.assertEqual([r.title for r in recs[0].m2m_field], ["rec0", "rec2"])
+        self.assertEqual([r.id for r in recs[2].m2m_field], [2])
+
+    def test_queryset_explain(self):
+        store = self.store
+        plan = store(Table2, Table2.title == "rec1").explain()
+        self.assertTrue(plan[0].detail.startswith("SCAN table2"))
+        plan = store(Table2, Table2.id == 1).explain()
+        self.assertTrue(plan[0].detail.startswith("SEARCH table2"))
+
+
+class IdentityMapTest(unittest.TestCase):
+    def setUp(self):
+        self.store = store = Store("sqlite://:memory:", identity_map=True)
+        store.create_table(Table2)
+
+    def test_store_identity_map(self):
+        store = self.store
+        rec = Table2(title="rec1")
+        store.add(rec)
+        store.add(Table2(title="rec2"))
+        self.assertIs(store(Table2, Table2.id == 1).all()[0], rec)
+        first = store(Table2, Table2.id == 2).all()[0]
+        rec.title = "changed"
+        recs = store(Table2).all()
+        self.assertIs(recs[0], rec)
+        self.assertIs(recs[1], first)
+        self.assertEqual(recs[0].title, "changed")
+        store.delete(first)
+        del first, recs
+        rec3 = Table2(title="rec3")
+        store.add(rec3)
+        self.assertEqual(
+            sorted(key[1] for key in store._identity.keys()), [1, 3])
+
+    def test_store_identity_map_bulk_update(self):
+        store = self.store
+        rec = Table2(title="rec1")
+        store.add(rec)
+        store(Table2).update(title="new")
+        loaded = store(Table2).all()[0]
+        self.assertIsNot(loaded, rec)
+        self.assertEqual(loaded.title, "new")
+
+    def test_store_identity_map_raw_rollback(self):
+        store = self.store
+        rec = Table2(title="old")
+        store.add(rec)
+        store.raw("update table2 set title='new'")
+        loaded = store(Table2).all()[0]
+        self.assertIsNot(loaded, rec)
+        self.assertEqual(loaded.title, "new")
+        try:
+            with store.transaction():
+                store.raw("update table2 set title='gone'")
+                gone = store(Table2).all()[0]
+                self.assertEqual(gone.title, "gone")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(store(Table2).all()[0].title, "new")
+
+    def test_store_no_identity_map(self):
+        store = Store("sqlite://:memory:")
+        store.create_table(Table2)
+        rec = Table2(title="rec1")
+        store.add(rec)
+        self.assertIsNot(store(Table2).all()[0], rec)
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.store = store = Store("sqlite://:memory:", cache_size=10)
+        store.create_table(Table2)
+
+    def test_store_result_cache(self):
+        store = Store("sqlite://:memory:", cache_size=2)
+        store.create_table(Table2)
+        store.add(Table2(title="rec1"))
+        qs = store(Table2, Table2.title == "rec1")
+        self.assertEqual(len(qs.all()), 1)
+        store._cursor.execute("insert into table2 (title) values ('rec1')")
+        self.assertEqual(len(qs.all()), 1)
+        self.assertEqual(qs.count(), 2)
+        self.assertEqual(store.cache_info()[:2], (1, 2))
+        store.add(Table2(title="rec1"))
+        self.assertEqual(len(qs.all()), 3)
+        store(Table2).count()
+        store(Table2).exists()
+        self.assertEqual(store.cache_info().evictions, 1)
+        self.assertEqual(store.cache_info().currsize, 2)
+
+    def test_store_result_cache_invalidate(self):
+        store = self.store
+        store.create_table(Table5)
+        store.add(Table2(title="rec1"))
+        store.add(Table5(text_field="t"))
+        self.assertEqual(store(Table2).count(), 1)
+        self.assertEqual(store(Table5).count(), 1)
+        store.raw("insert into table2 (title) values ('rec2')")
+        self.assertEqual(store(Table2).count(), 2)
+        self.assertEqual(store(Table5).count(), 1)
+        self.assertEqual(store.cache_info().hits, 1)
+        store(Table2, Table2.id == 1).update(title="x")
+        self.assertEqual(store(Table2, Table2.title == "x").count(), 1)
+        store(Table2).delete()
+        self.assertFalse(store(Table2).exists())
+        with self.assertRaises(ValueError):
+            with store.transaction():
+                store.add(Table2(title="rec3"))
+                self.assertEqual(store(Table2).count(), 1)
+                raise ValueError
+        self.assertEqual(store(Table2).count(), 0)
+
+    def test_store_result_cache_keys(self):
+        store = self.store
+        store.add(Table2(title="rec1"))
+        for value in (bytearray(b"x"), memoryview(bytearray(b"x"))):
+            self.assertEqual(store(Table2, Table2.title == value).count(), 0)
+        self.assertEqual(store.cache_info().currsize, 0)
+        self.assertEqual(store(Table2).count(), 1)
+        store.raw("insert into main.table2 (title) values ('rec2')")
+        self.assertEqual(store(Table2).count(), 2)
+
+    def test_store_result_cache_ttl(self):
+        store = Store("sqlite://:memory:", cache_size=10, cache_ttl=0)
+        store.create_table(Table2)
+        store(Table2).count()
+        store(Table2).count()
+        self.assertEqual(store.cache_info().hits, 0)
+        self.assertIsNone(Store("sqlite://:memory:").cache_info())
+
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        self.store = store = Store("sqlite://:memory:")
+        store.create_table(Table2)
+
+    def test_store_advise(self):
+        store = self.store
+        store.add_many(Table2(title="rec{}".format(i)) for i in range(20))
+        with store.advise(min_rows=10) as advisor:
+            store(Table2, Table2.title == "rec1").all()
+            store(Table2, Table2.title == "rec2").all()
+            store(Table2, Table2.id > 5).count()
+            store(Table2).all()
+        advice = advisor.advice()
+        self.assertEqual(len(advice), 1)
+        self.assertEqual(advice[0].count, 2)
+        self.assertEqual((advice[0].table, advice[0].rows), ("table2", 20))
+        index_sql = advice[0].index.sql("table2")
+        self.assertEqual(index_sql,
+            "create index if not exists table2_title_idx on table2 (title)")
+        with store.advise(min_rows=100) as small:
+            store(Table2, Table2.title == "rec1").all()
+        self.assertEqual(small.advice(), [])
+        self.assertIsNone(store._advisor)
+        store.raw(index_sql)
+        self.assertEqual(advisor.advice(), [])
+
+    def test_store_listeners(self):
+        store = self.store
+        events = []
+        store.add_listener(events.append)
+        store.create_table(Table2)
+        store.add_many([Table2(title="rec1"), Table2(title="rec2")])
+        recs = list(store(Table2).order_by(Table2.id))
+        store.remove_listener(events.append)
+        store.raw("select * from table2")
+        self.assertEqual([r.title for r in recs], ["rec1", "rec2"])
+        self.assertEqual(
+            [e.sql.split(" ")[0] for e in events],
+            ["create", "begin", "insert", "select", "commit", "select"])
+        self.assertEqual(events[2].rows, 2)
+        self.assertEqual(events[-1].rows, 2)
+        self.assertGreater(events[-1].hydration, 0)
+
+    def test_store_profile(self):
+        store = self.store
+        with store.profile() as stats:
+            for i in range(3):
+                store.add(Table2(title="rec{}".format(i)))
+                store(Table2, Table2.id == i).all()
+            store.raw("select * from table2 where id in (1, 2)")
+            store.raw("select * from table2 where title = 'it''s'")
+        store.raw("select * from table2 where id = 2")
+        top = {st.sql: st for st in stats.top()}
+        self.assertEqual(len(top), 4)
+        self.assertEqual(top["insert into table2 (title) values (?)"].calls, 3)
+        self.assertEqual(
+            top["select * from table2 where id in (...)"].rows, 2)
+        self.assertEqual(top["select * from table2 where title = ?"].calls, 1)
+        self.assertEqual(len(stats.report(2).splitlines()), 3)
+        with self.assertLogs("monkey", level="WARNING") as logs:
+            with store.profile(slow=0) as stats:
+                store(Table2).count()
+        self.assertIn("select count(*) from table2", logs.output[0])
+
+    def test_store_detect_repeats(self):
+        store = self.store
+        for i in range(5):
+            store.add(Table2(title="rec{}".format(i)))
+        with self.assertWarns(RepeatedQueryWarning) as cm:
+            with store.detect_repeats(limit=3) as detector:
+                for i in range(5):
+                    store(Table2, Table2.id == i).all()
+                store(Table2).count()
+        self.assertEqual(cm.filename, __file__)
+        self.assertEqual(detector.repeated(), [(
+            "select table2.id, table2.title from table2 where table2.id = ?", 5)])
+        with self.assertRaises(RepeatedQuery):
+            with store.detect_repeats(limit=2, error=True):
+                for i in range(5):
+                    store(Table2, Table2.id == i).count()
+        self.assertEqual(store._listeners, [])
+
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def db(self, name):
+        return "sqlite://{}".format(os.path.join(self.tmp.name, name))
+
+
+class PooledStoreTest(TempDirTest):
+    def test_pooled_store(self):
+        store = PooledStore(self.db("pool.db"), pool_size=2)
+        store.create_table(Table2)
+        store.release()
+        conns = set()
+        errors = []
+
+        def work(n):
+            try:
+                for i in range(20):
+                    store.add(Table2(title="rec{}-{}".format(n, i)))
+                with store.transaction():
+                    store(Table2, Table2.title == "rec{}-0".format(n)).update(title="first")
+                conns.add(id(store._conn))
+                store.release()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(conns), 2)
+        self.assertEqual(store(Table2).count(), 80)
+        self.assertEqual(store(Table2, Table2.title == "first").count(), 4)
+        store.close()
+
+    def test_pooled_store_cache(self):
+        store = PooledStore(self.db("cache.db"), pool_size=2, cache_size=10)
+        store.create_table(Table2)
+        store.add(Table2(title="rec1"))
+        written = threading.Event()
+        read = threading.Event()
+
+        def write():
+            with store.transaction():
+                store.add(Table2(title="rec2"))
+                written.set()
+                read.wait()
+            store.release()
+        thread = threading.Thread(target=write)
+        thread.start()
+        written.wait()
+        # reads the rows committed before the transaction
+        self.assertEqual(store(Table2).count(), 1)
+        read.set()
+        thread.join()
+        self.assertEqual(store(Table2).count(), 2)
+        store.close()
+
+    def test_pooled_store_read_then_write(self):
+        store = PooledStore(self.db("rw.db"), pool_size=4)
+        store.create_table(Table2)
+        store.release()
+        errors = []
+        barrier = threading.Barrier(4)
+
+        def work():
+            try:
+                barrier.wait()
+                for _ in range(5):
+                    with store.transaction():
+                        store(Table2).count()
+                        # lets the other threads read too
+                        time.sleep(0.01)
+                        store.add(Table2(title="rec"))
+                store.release()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(store(Table2).count(), 20)
+        store.close()
+
+    def test_pooled_store_memory(self):
+        store = PooledStore("sqlite://:memory:", pool_size=4)
+        store.create_table(Table2)
+        store.release()
+        errors = []
+
+        def work():
+            try:
+                for _ in range(50):
+                    with store.connection():
+                        store.add(Table2(title="rec"))
+                        store(Table2).count()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(store(Table2).count(), 200)
+
+    def test_pooled_store_timeout(self):
+        store = PooledStore("sqlite://:memory:", pool_size=1, timeout=0.01)
+        store.create_table(Table2)
+        store.add(Table2(title="rec1"))
+        errors = []
+        counts = []
+
+        def work():
+            try:
+                with store.connection():
+                    counts.append(store(Table2).count())
+            except PoolTimeout as e:
+                errors.append(e)
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.assertEqual((len(errors), counts), (1, []))
+        store.release()
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.assertEqual((len(errors), counts), (1, [1]))
+
+
+class WalStoreTest(TempDirTest):
+    def test_wal_store(self):
+        store = WalStore(self.db("wal.db"), pool_size=2, max_batch=5000)
+        store.create_table(Table2)
+        events = []
+        store.add_listener(events.append)
+        futures = [store.add(Table2(title="rec{}".format(i))) for i in range(100)]
+        self.assertEqual(futures[-1].result().id, 100)
+        commits = [e for e in events if e.sql == "commit"]
+        self.assertLess(len(commits), 100)
+        self.assertEqual(store(Table2).count(), 100)
+        self.assertEqual(
+            store.raw("pragma journal_mode"), [("wal",)])
+        with self.assertRaises(sqlite3.OperationalError):
+            store._conn.execute("delete from table2")
+        failing = store.add(Table5(text_field="x"))
+        rec = store.add(Table2(title="rec")).result()
+        self.assertRaises(sqlite3.OperationalError, failing.result)
+        self.assertEqual(rec.id, 101)
+        store.delete(rec).result()
+        self.assertEqual(store(Table2, Table2.id > 50).delete(), 50)
+        with store.unit_of_work():
+            store + Table2(title="rec")
+        self.assertEqual(store(Table2).count(), 51)
+        store.add_many(Table2(title="rec") for _ in range(10)).result()
+        with store.transaction():
+            self.assertEqual(store(Table2).count(), 61)
+            self.assertRaises(ReadOnlyTransaction, store.add, Table2(title="rec"))
+            self.assertRaises(ReadOnlyTransaction, store(Table2).delete)
+        # coalesced adds larger than add_many() batches, one of them failing
+        recs = [Table2(title="more") for _ in range(1500)]
+        futures = [store.add(rec) for rec in recs[:700]]
+        failing = store.add(Table5(text_field="x"))
+        futures += [store.add(rec) for rec in recs[700:]]
+        self.assertEqual([f.result() for f in futures], recs)
+        self.assertRaises(sqlite3.OperationalError, failing.result)
+        self.assertEqual(len(set(rec.id for rec in recs)), 1500)
+        self.assertEqual(store(Table2).count(), 1561)
+        store.close()
+        store = Store(self.db("wal.db"))
+        self.assertEqual(store(Table2).count(), 1561)
+        store.close()
+
+
+class AsyncStoreTest(TempDirTest):
+    def test_async_store(self):
+        async def run(db):
+            async with AsyncStore(db, workers=2) as store:
+                await store.create_table(Table2)
+                rec = Table2(title="rec")
+                await store.add(rec)
+                self.assertEqual(rec.id, 1)
+                await store.add_many(Table2(title="rec{}".format(i)) for i in range(99))
+                counts = await asyncio.gather(
+                    store(Table2).count(),
+                    store(Table2, Table2.id > 50).count())
+                self.assertEqual(counts, [100, 50])
+                ids = []
+                async for rec in store(Table2).order_by(Desc(Table2.id)).iterator(30):
+                    ids.append(rec.id)
+                self.assertEqual(ids, list(range(100, 0, -1)))
+                self.assertEqual(
+                    [r.id for r in await store(Table2)[10:12].all()], [11, 12])
+                self.assertEqual(await store(Table2, Table2.id > 10).delete(), 90)
+                self.assertEqual(await store.raw("select count(*) from table2"), [(10,)])
+
+        asyncio.run(run("sqlite://:memory:"))
+        asyncio.run(run(self.db("async.db")))
+
+    def test_async_store_streams(self):
+        async def iterate(store):
+            return [rec.id async for rec in store(Table2).iterator(10)]
+
+        async def run(db):
+            async with AsyncStore(db, workers=2, streams=2) as store:
+                await store.create_table(Table2)
+                await store.add_many(Table2(title="rec") for _ in range(50))
+                results = await asyncio.wait_for(
+                    asyncio.gather(*[iterate(store) for _ in range(8)]), 5)
+                self.assertEqual(results, [list(range(1, 51))] * 8)
+
+        asyncio.run(run(self.db("async.db")))
+
+    def test_async_store_write_while_streaming(self):
+        async def run(db):
+            async with AsyncStore(db, workers=2) as store:
+                await store.create_table(Table2)
+                await store.add_many(Table2(title="rec") for _ in range(50))
+                ids = []
+                async for rec in store(Table2).iterator(10):
+                    if not ids:
+                        await asyncio.wait_for(store.add(Table2(title="new")), 2)
+                    ids.append(rec.id)
+                self.assertEqual(ids, list(range(1, 51)))
+                self.assertEqual(await store(Table2).count(), 51)
+
+        asyncio.run(run(self.db("async.db")))
+
+
+class WriteBehindTest(TempDirTest):
+    def test_store_write_behind(self):
+        store = Store(self.db("wb.db"), cache_size=10)
+        store.create_table(Table2)
+        self.assertRaises(ValueError, Store("sqlite://:memory:").write_behind)
+        with store.write_behind(batch_size=10, interval=60, max_pending=20) as buffer:
+            recs = [Table2(title="rec{}".format(i)) for i in range(105)]
+            for rec in recs:
+                store + rec
+            self.assertLessEqual(len(buffer._pending), 20)
+            buffer.flush()
+            self.assertEqual(store(Table2).count(), 105)
+            self.assertEqual([rec.id for rec in recs], list(range(1, 106)))
+            store + Table5(text_field="x")
+            store + Table2(title="rec")
+            with self.assertRaises(WriteBehindError) as cm:
+                buffer.flush()
+            self.assertEqual(len(cm.exception.errors), 1)
+            store + Table2(title="last")
+        self.assertIsNone(store._buffer)
+        self.assertEqual(store(Table2).count(), 107)
+        # a failing write bigger than batch_size is retried record by record
+        with store.write_behind(batch_size=10, interval=60) as buffer:
+            recs = [Table2(title="more{}".format(i)) for i in range(50)]
+            buffer._write(recs[:25] + [Table5(text_field="x")] + recs[25:])
+            self.assertEqual(len(buffer.errors), 1)
+            self.assertRaises(WriteBehindError, buffer.flush)
+        self.assertEqual([rec.id for rec in recs], list(range(108, 158)))
+        self.assertEqual(store(Table2).count(), 157)
+        store.close()
+
+
+def _title_len(rec):
+    return len(rec.title)
+
+def _double(x):
+    return x * 2
+
+def _count(acc, rec):
+    return acc + 1
+
+def _append_id(acc, rec):
+    return acc + [rec.id]
+
+
+class ParallelTest(TempDirTest):
+    def test_queryset_parallel(self):
+        store = Store(self.db("parallel.db"))
+        store.create_table(Table2)
+        store.add_many(Table2(title="rec{}".format(i)) for i in range(1000))
+        qs = store(Table2, Table2.id > 100)
+        recs = list(qs.parallel(workers=2, partitions=7))
+        self.assertEqual([rec.id for rec in recs], list(range(101, 1001)))
+        self.assertEqual(qs.parallel(workers=2, map=_title_len, reduce=operator.add),
+            sum(len(rec.title) for rec in recs))
+        self.assertEqual(
+            store(Table2).parallel(2, reduce=_count, initial=0, combine=operator.add), 1000)
+        ids = qs.parallel(2, reduce=_append_id, initial=[], combine=operator.add)
+        self.assertEqual(ids, list(range(101, 1001)))
+        self.assertRaises(ValueError, qs.parallel, 2, reduce=_count, initial=0)
+        empty = store(Table2, Table2.id > 1000)
+        self.assertEqual(
+            empty.parallel(2, _title_len, operator.add, 0, operator.add), 0)
+        self.assertRaises(ValueError, store(Table2).order_by(Table2.title).parallel)
+        self.assertEqual(list(store(Table2).values_list(Table2.id, flat=True).parallel(
+            workers=2, map=_double))[:3], [2, 4, 6])
+        self.assertRaises(ValueError, store(Table2)[:10].parallel)
+        self.assertRaises(ValueError,
+            Store("sqlite://:memory:")(Table2).parallel)
+        store.close()